@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+#    Benchmarks for mpd-random-playlist-album.py and mopidy-random-playlist-album.py.
+#    Copyright (C) 2009  Kyle MacLeod  kyle.macleod is at gmail
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Description
+-----------
+Times the AlbumList operations of mpd-random-playlist-album.py and
+mopidy-random-playlist-album.py against synthetic playlists, using a mocked MPD client
+(no MPD server is needed, but the mpd module must be importable).
+
+For each variant, operation and playlist size the median time of a few samples and the
+peak memory allocated during one run are recorded. Each sample repeats the operation for at
+least 0.2 seconds, so that short operations are not at the mercy of timer and scheduling
+noise. Results are compared against a stored baseline; the script exits with status 1 if
+any operation is slower (or uses more memory) than its baseline by more than the tolerance,
+or if there is no baseline to compare against. Differences below 1 ms or 4 KiB, or within
+the spread of the timed samples, are ignored as noise.
+
+Timings depend on the machine. The committed benchmark-baseline.json is a reference only;
+to check a change, record a baseline with --save on the same machine before making it.
+
+Operations:
+
+    mpd    : _create_album_list, _create_last_song_list, _choose_random_album (x1000),
+             _process_album_queue, is_last_song_in_album (x1000),
+             _fetch_playlist_info(serial), _fetch_playlist_info(pool),
+             _create_last_song_list(serial), _create_last_song_list(pool)
+    mopidy : _parse_playlist_info, _choose_random_album (x1000), _process_album_queue,
+             is_last_song_in_album (x1000), refresh(rpc)
+
+The (serial) and (pool) operations compare the refresh queries over the main connection
+with the same queries spread over a ConnectionPool (see -j). They run against a mock which
+sleeps for each request and for each entry returned, like a real server would take time.
+refresh(rpc) loads the tracklist through MopidyRpcClient from a local stand-in for Mopidy's
+HTTP JSON-RPC endpoint.
+
+Once an operation takes longer than --max-seconds, larger sizes are skipped for it. Skipped
+operations which are in the baseline count as regressions.
+
+Options:
+
+    -h|--help
+    -s|--sizes N,N,..    : Playlist sizes in songs [default=100,1000,10000,100000,500000]
+    -r|--repeat N        : Number of timed samples per measurement, the median is kept [default=5]
+    -b|--baseline FILE   : Baseline file [default=benchmark-baseline.json in this directory]
+    -S|--save            : Save the results as the new baseline instead of comparing
+    -t|--tolerance X     : Allowed slowdown before failing, e.g. 0.5 = 50% [default=0.5]
+    -m|--max-seconds X   : Skip larger sizes once an operation takes longer than this [default=10]
+    -p|--plot FILE       : Plot the scaling curves to FILE (requires matplotlib)
+    -j|--jobs N          : Connection pool size for the (pool) operations [default=4]
+    -l|--latency MS      : Mock server latency per request, in milliseconds [default=1]
+
+Examples
+--------
+
+    ./benchmark-random-playlist-album.py -S            # record a baseline
+    ./benchmark-random-playlist-album.py               # compare against it
+    ./benchmark-random-playlist-album.py -s 100,1000 -p scaling.png
+"""
+
+import contextlib
+import getopt
+import http.server
+import importlib.util
+import json
+import logging
+import os
+import os.path
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+VARIANTS = {
+    'mpd': 'mpd-random-playlist-album.py',
+    'mopidy': 'mopidy-random-playlist-album.py',
+}
+
+# number of calls per measurement for the per-song/per-pick operations
+CALLS = 1000
+
+# differences smaller than these are treated as noise, whatever the ratio
+NOISE_FLOOR = {'seconds': 0.001, 'peak_bytes': 4096}
+
+# minimum duration of each timed sample; shorter operations are run several times per sample
+MIN_SAMPLE_SECONDS = 0.2
+
+# connection pool size and mock server latency for the (serial) and (pool) operations,
+# see -j and -l. Each request takes REQUEST_LATENCY plus ENTRY_LATENCY per entry returned.
+JOBS = 4
+REQUEST_LATENCY = 0.001
+ENTRY_LATENCY = 0.000002
+
+
+def script_help():
+    print(__doc__)
+    sys.exit(-1)
+
+
+def load_script(variant):
+    """Imports one of the album scripts as a module.
+    """
+    spec = importlib.util.spec_from_file_location(variant.replace('-', '_') + '_random_playlist_album',
+                                                  os.path.join(SCRIPT_DIR, VARIANTS[variant]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_playlist(num_songs, seed=42):
+    """Returns a synthetic playlistinfo() result of num_songs entries, arranged as albums
+    of 1 to 20 songs.
+    """
+    rnd = random.Random(seed)
+    genres = ['Rock', 'Jazz', 'Folk', 'Classical', 'Electronic']
+    plinfo = []
+    album_no = 0
+    while len(plinfo) < num_songs:
+        artist = 'Artist {}'.format(rnd.randint(0, num_songs // 50 + 1))
+        album = 'Album {} of {}'.format(album_no, artist)
+        genre = rnd.choice(genres)
+        for track in range(1, min(rnd.randint(1, 20), num_songs - len(plinfo)) + 1):
+            pos = len(plinfo)
+            plinfo.append({'file': '{}/{}/{:02d} - Song.flac'.format(artist, album, track),
+                           'time': str(rnd.randint(60, 600)), 'artist': artist, 'album': album,
+                           'title': 'Song {}'.format(track), 'track': str(track), 'date': '1970',
+                           'genre': genre, 'pos': str(pos), 'id': str(pos + 1)})
+        album_no += 1
+    return plinfo
+
+
+class MockClient:
+    """Answers the MPD commands used by AlbumList from a synthetic playlist, without any I/O.
+    """
+    mpd_version = '0.23.0'
+
+    def __init__(self, plinfo):
+        self._plinfo = plinfo
+        self._by_album = {}
+        for entry in plinfo:
+            self._by_album.setdefault(entry['album'], []).append(entry)
+
+    def status(self):
+        return {'playlistlength': str(len(self._plinfo)), 'playlist': '1'}
+
+    def playlistinfo(self, window=None):
+        if window is None:
+            return self._plinfo
+        start, _, end = str(window).partition(':')
+        return self._plinfo[int(start):int(end) if end else int(start) + 1]
+
+    def playlistfind(self, tag, value):
+        return self._by_album.get(value, []) if tag == 'album' else []
+
+    def currentsong(self):
+        return self._plinfo[0] if self._plinfo else {}
+
+    def play(self, pos):
+        pass
+
+    def close(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class LatencyClient(MockClient):
+    """A MockClient which takes time to answer, like a real server: each request sleeps for
+    REQUEST_LATENCY plus ENTRY_LATENCY per entry returned.
+    """
+    def _answer(self, result):
+        time.sleep(REQUEST_LATENCY + ENTRY_LATENCY * len(result))
+        return result
+
+    def status(self):
+        return self._answer(MockClient.status(self))
+
+    def playlistinfo(self, window=None):
+        return self._answer(MockClient.playlistinfo(self, window))
+
+    def playlistfind(self, tag, value):
+        return self._answer(MockClient.playlistfind(self, tag, value))
+
+
+def make_tl_tracks(plinfo):
+    """Returns the playlist as Mopidy TlTrack models, as core.tracklist.get_tl_tracks would.
+    """
+    return [{'__model__': 'TlTrack', 'tlid': int(entry['id']),
+             'track': {'__model__': 'Track', 'uri': 'local:track:' + entry['file'], 'name': entry['title'],
+                       'artists': [{'__model__': 'Artist', 'name': entry['artist']}],
+                       'album': {'__model__': 'Album', 'name': entry['album']},
+                       'length': int(entry['time']) * 1000, 'track_no': int(entry['track']),
+                       'date': entry['date'], 'genre': entry['genre']}}
+            for entry in plinfo]
+
+
+class MockRpcServer:
+    """A stand-in for Mopidy's HTTP JSON-RPC endpoint, answering the calls made by
+    MopidyRpcClient from a background thread. The results are encoded once up front, so the
+    time measured is mostly spent in the client.
+    """
+    def __init__(self, plinfo):
+        results = {
+            'core.tracklist.get_tl_tracks': json.dumps(make_tl_tracks(plinfo)).encode('utf-8'),
+            'core.tracklist.get_version': b'1',
+            'core.tracklist.get_length': str(len(plinfo)).encode('utf-8'),
+            'core.playback.play': b'null',
+        }
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                calls = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                body = b'[' + b','.join(b'{"jsonrpc": "2.0", "id": %d, "result": %s}' % (call['id'], results[call['method']])
+                                        for call in calls) + b']'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/mopidy/rpc'.format(self._server.server_port)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def write_album_queue(module, plinfo):
+    """Fills the album queue with a few misses and a final hit near the end of the playlist."""
+    last_album = plinfo[-1]['album']
+    with open(module.MPD_RANDOM_ALBUM_QUEUE_FILE, 'w') as f:
+        f.write('no such album one\nno such album two\n!no such album three\n{}\n'.format(last_album))
+
+
+def operations(variant, module, plinfo, resources):
+    """Returns a list of (name, setup, run) for the given variant. setup() returns the state
+    passed to run(state); only run() is measured. Anything which needs closing afterwards
+    is entered into resources, an ExitStack.
+    """
+    client = MockClient(plinfo)
+    songs = random.Random(1).sample(plinfo, min(CALLS, len(plinfo)))
+
+    def new_albumlist():
+        albumlist = module.AlbumList(client)
+        if variant == 'mpd':
+            albumlist.refresh()
+        else:
+            albumlist._pl_info = plinfo
+            albumlist._parse_playlist_info()
+        return albumlist
+
+    def choose_random_album(albumlist):
+        for song in songs:
+            albumlist._choose_random_album(song['album'])
+
+    def process_album_queue(albumlist):
+        # the queue is consumed, so it is refilled on every run
+        write_album_queue(module, plinfo)
+        albumlist._process_album_queue()
+
+    def is_last_song_in_album(albumlist):
+        for song in songs:
+            albumlist.is_last_song_in_album(song)
+
+    ops = []
+    if variant == 'mpd':
+        def setup_create_last_song_list():
+            albumlist = module.AlbumList(client)
+            albumlist._create_album_list(plinfo)
+            return albumlist
+        ops.append(('_create_album_list', lambda: module.AlbumList(client),
+                    lambda albumlist: albumlist._create_album_list(plinfo)))
+        ops.append(('_create_last_song_list', setup_create_last_song_list,
+                    lambda albumlist: albumlist._create_last_song_list(plinfo)))
+
+        latency_client = LatencyClient(plinfo)
+        pool = resources.enter_context(contextlib.closing(
+            module.ConnectionPool(JOBS, lambda: LatencyClient(plinfo))))
+        for label, albumlist_pool in (('serial', None), ('pool', pool)):
+            def setup_fetch(albumlist_pool=albumlist_pool):
+                return module.AlbumList(latency_client, pool=albumlist_pool)
+
+            def setup_last_song_list(albumlist_pool=albumlist_pool):
+                albumlist = module.AlbumList(latency_client, pool=albumlist_pool)
+                albumlist._create_album_list(plinfo)
+                return albumlist
+            ops.append(('_fetch_playlist_info({})'.format(label), setup_fetch,
+                        lambda albumlist: albumlist._fetch_playlist_info()))
+            ops.append(('_create_last_song_list({})'.format(label), setup_last_song_list,
+                        lambda albumlist: albumlist._create_last_song_list(plinfo)))
+    else:
+        def setup_parse_playlist_info():
+            albumlist = module.AlbumList(client)
+            albumlist._pl_info = plinfo
+            return albumlist
+        ops.append(('_parse_playlist_info', setup_parse_playlist_info,
+                    lambda albumlist: albumlist._parse_playlist_info()))
+
+        rpc_server = resources.enter_context(contextlib.closing(MockRpcServer(plinfo)))
+        ops.append(('refresh(rpc)', lambda: module.AlbumList(module.MopidyRpcClient(rpc_server.url)),
+                    lambda albumlist: albumlist.refresh()))
+    ops.append(('_choose_random_album', new_albumlist, choose_random_album))
+    ops.append(('_process_album_queue', new_albumlist, process_album_queue))
+    ops.append(('is_last_song_in_album', new_albumlist, is_last_song_in_album))
+    return ops
+
+
+def measure(setup, run, repeat):
+    """Returns (median seconds per run, spread of the samples in seconds, peak bytes allocated
+    by one run). Each of the repeat samples calls run(state) on a new setup() state until
+    MIN_SAMPLE_SECONDS have passed.
+    """
+    samples = []
+    for i in range(repeat):
+        state = setup()
+        runs = 0
+        time_start = time.perf_counter()
+        while True:
+            run(state)
+            runs += 1
+            elapsed = time.perf_counter() - time_start
+            if elapsed >= MIN_SAMPLE_SECONDS:
+                break
+        samples.append(elapsed / runs)
+    state = setup()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(samples), max(samples) - min(samples), peak
+
+
+def run_benchmarks(sizes, repeat, max_seconds):
+    """Returns {'variant/operation/size': {'seconds': s, 'peak_bytes': b}}.
+    """
+    results = {}
+    for variant in sorted(VARIANTS):
+        module = load_script(variant)
+        skipped = set()
+        for size in sizes:
+            plinfo = make_playlist(size)
+            with contextlib.ExitStack() as resources:
+                for name, setup, run in operations(variant, module, plinfo, resources):
+                    if name in skipped:
+                        continue
+                    seconds, spread, peak = measure(setup, run, repeat)
+                    key = '{}/{}/{}'.format(variant, name, size)
+                    results[key] = {'seconds': seconds, 'spread': spread, 'peak_bytes': peak}
+                    print("{:<50} {:>12.3f} ms {:>12.1f} KiB".format(key, seconds * 1000, peak / 1024.0))
+                    sys.stdout.flush()
+                    if seconds > max_seconds:
+                        print("{:<50} skipping larger sizes".format('{}/{}'.format(variant, name)))
+                        skipped.add(name)
+    return results
+
+
+def compare(results, baseline, tolerance, sizes):
+    """Prints a comparison with the baseline. Returns the list of regressed keys.
+
+    Baseline operations of the given sizes which were not measured (e.g. skipped once they
+    exceeded --max-seconds) count as regressions.
+    """
+    regressions = []
+    for key in sorted(baseline):
+        if key not in results and int(key.rsplit('/', 1)[1]) in sizes:
+            regressions.append(key)
+            print("MISSING    {:<50} not measured (skipped or removed)".format(key))
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            base = baseline[key][metric]
+            ratio = results[key][metric] / base if base > 0 else 1.0
+            noise = NOISE_FLOOR[metric]
+            if metric == 'seconds':
+                # a difference within what the samples themselves varied by is noise too
+                noise = max(noise, results[key]['spread'] + baseline[key].get('spread', 0))
+            if ratio > 1.0 + tolerance and results[key][metric] - base > noise:
+                regressions.append(key)
+                print("REGRESSION {:<50} {:<10} {:.2f}x baseline".format(key, metric, ratio))
+    return regressions
+
+
+def plot(results, filename):
+    """Plots time and peak memory against playlist size, one line per operation.
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed, not plotting")
+        return
+    series = {}
+    for key, value in results.items():
+        variant, name, size = key.split('/')
+        series.setdefault('{}/{}'.format(variant, name), []).append((int(size), value))
+    fig, (ax_time, ax_mem) = plt.subplots(1, 2, figsize=(14, 6))
+    for label, points in sorted(series.items()):
+        points.sort(key=lambda p: p[0])
+        ax_time.plot([p[0] for p in points], [p[1]['seconds'] for p in points], marker='o', label=label)
+        ax_mem.plot([p[0] for p in points], [p[1]['peak_bytes'] for p in points], marker='o', label=label)
+    for ax, ylabel in ((ax_time, 'seconds'), (ax_mem, 'peak bytes')):
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel('playlist size (songs)')
+        ax.set_ylabel(ylabel)
+        ax.grid(True, which='both', alpha=0.3)
+    ax_time.legend(fontsize='small')
+    fig.tight_layout()
+    fig.savefig(filename)
+    print("Plotted scaling curves to '{}'".format(filename))
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:r:b:St:m:p:j:l:",
+                                   ["help", "sizes=", "repeat=", "baseline=", "save", "tolerance=",
+                                    "max-seconds=", "plot=", "jobs=", "latency="])
+    except getopt.GetoptError:
+        # print help information and exit:
+        script_help()
+        return 2
+    arg_sizes = [100, 1000, 10000, 100000, 500000]
+    arg_repeat = 5
+    arg_baseline = os.path.join(SCRIPT_DIR, 'benchmark-baseline.json')
+    arg_save = False
+    arg_tolerance = 0.5
+    arg_max_seconds = 10.0
+    arg_plot = None
+    global JOBS, REQUEST_LATENCY
+    try:
+        for o, a in opts:
+            if o in ("-h", "--help"):
+                script_help()
+            elif o in ("-s", "--sizes"):
+                arg_sizes = [int(size) for size in a.split(',')]
+            elif o in ("-r", "--repeat"):
+                arg_repeat = int(a)
+            elif o in ("-b", "--baseline"):
+                arg_baseline = a
+            elif o in ("-S", "--save"):
+                arg_save = True
+            elif o in ("-t", "--tolerance"):
+                arg_tolerance = float(a)
+            elif o in ("-m", "--max-seconds"):
+                arg_max_seconds = float(a)
+            elif o in ("-p", "--plot"):
+                arg_plot = a
+            elif o in ("-j", "--jobs"):
+                JOBS = int(a)
+            elif o in ("-l", "--latency"):
+                REQUEST_LATENCY = float(a) / 1000
+    except ValueError:
+        script_help()
+    # the scripts log at info level in their hot paths; keep the output to the results
+    logging.basicConfig(level=logging.WARNING)
+    # keep the benchmark away from the real album queue
+    queue_dir = tempfile.mkdtemp(prefix='mpd-benchmark-')
+    os.environ['MPD_RANDOM_ALBUM_QUEUE_FILE'] = os.path.join(queue_dir, 'mpd.albumq')
+    os.environ['MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE'] = ''
+    os.environ['MPD_RANDOM_SUSPEND_FILE'] = os.path.join(queue_dir, 'mpd.norandom')
+
+    results = run_benchmarks(arg_sizes, arg_repeat, arg_max_seconds)
+    if arg_plot:
+        plot(results, arg_plot)
+    if arg_save:
+        with open(arg_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to '{}'".format(arg_baseline))
+        return 0
+    if not os.path.exists(arg_baseline):
+        print("FAILED: no baseline found at '{}'; run with --save to create one".format(arg_baseline))
+        return 1
+    with open(arg_baseline) as f:
+        baseline = json.load(f)
+    if compare(results, baseline, arg_tolerance, arg_sizes):
+        return 1
+    print("No regressions against '{}'".format(arg_baseline))
+    return 0
+
+
+###############################################################################
+if __name__ == "__main__" or __name__ == "main":
+    sys.exit(main())
+###############################################################################
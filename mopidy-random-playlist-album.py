@@ -35,6 +35,10 @@ Options:
                    a new random album from the playlist
     -D|--debug   : Print debug messages to stdout
     -p|--passive : Testing only. Does not make any changes to the MPD playlist.
+    -r|--rpc URL : Load the tracklist and play albums through Mopidy's HTTP JSON-RPC API
+                   at URL (e.g. http://localhost:6680/mopidy/rpc) instead of the MPD
+                   protocol emulation, which is much slower for large tracklists.
+                   [default=$MOPIDY_RPC_URL]. MPD is still used to watch for track changes.
 
 Dependencies:
 
@@ -95,15 +99,18 @@ Start a daemon, logging output to /tmp/mpd-random-playlist-album.log
 """
 
 import getopt
+import json
 import logging
 import mpd
 import os
 import os.path
 import random
+import socket
 import sys
 import tempfile
 import time
 import traceback
+import urllib.request
 
 # If this file exists then no random album is chosen. Used to easily disable the daemon
 # e.g. touch /tmp/mpd.norandom && sleep 3600 && rm -f /tmp/mpd.norandom
@@ -130,6 +137,16 @@ MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE = os.getenv('MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_
 if MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE is None:
     MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE = MPD_RANDOM_ALBUM_QUEUE_FILE + '.archive'
 
+# URL of the Mopidy HTTP JSON-RPC endpoint. If set, the tracklist is loaded and albums are played
+# via Mopidy's core API rather than through its MPD protocol emulation. Overridden by the -r option.
+MOPIDY_RPC_URL = os.getenv('MOPIDY_RPC_URL')
+
+# Timeout in seconds for a single JSON-RPC request
+MOPIDY_RPC_TIMEOUT = float(os.getenv('MOPIDY_RPC_TIMEOUT', '30'))
+
+# Errors raised when the connection to mpd is lost: mpd's own, and the socket level ones
+MPD_CONNECTION_ERRORS = (mpd.ConnectionError, ConnectionError, socket.timeout)
+
 # This is used for testing purposes
 PASSIVE_MODE = False
 
@@ -153,12 +170,13 @@ def idle_loop(client, albumlist):
     """
     time_song_start = time.time()
     while 1:
-        logging.debug("idle_loop: current song: {}".format(client.currentsong()))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("idle_loop: current song: %s", client.currentsong())
         try:
             prevsong = client.currentsong()
             at_last_song = albumlist.is_last_song_in_album(prevsong)
             reasons = client.idle('player','playlist') # blocking
-            logging.debug("idle_loop wakeup: response from client.idle: {}".format(str(reasons)))
+            logging.debug("idle_loop wakeup: response from client.idle: %s", reasons)
 
             # streams come in with ['playlist', 'player'] on song change
             # (with mopidy it is just 'player')
@@ -168,6 +186,12 @@ def idle_loop(client, albumlist):
                 albumlist.refresh()
                 continue
 
+            # mopidy only reports 'player', so check whether the tracklist was edited. The end
+            # of album check below still applies: at_last_song was worked out from the index
+            # as it was before this wakeup, and the next album is chosen from the new one. In
+            # consume mode the version changes on every song change.
+            albumlist.refresh_if_changed()
+
             if not at_last_song:
                 # Ignore everything unless we were at the last song on the current album.
                 # This is a hack so that we ignore the user changing the playlist. We're
@@ -182,8 +206,10 @@ def idle_loop(client, albumlist):
                 # handle end of playlist
                 logging.info("end of playlist detected")
                 albumlist.play_next_album(prevsong['album'])
-            elif currsong['pos'] != prevsong['pos']:
-                logging.debug("song change detected: prev: {} curr: {}".format(song_info(prevsong), song_info(currsong)))
+            elif currsong['pos'] != prevsong['pos'] or currsong.get('id') != prevsong.get('id'):
+                # (in consume mode the next song moves up into the position of the last one)
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("song change detected: prev: %s curr: %s", song_info(prevsong), song_info(currsong))
                 if currsong['album'] != prevsong['album']:
                     # Check that we are at the end of the last song. This is to handle the case where the user
                     # changes the current song when we're at the last song in an album
@@ -192,18 +218,21 @@ def idle_loop(client, albumlist):
                         song_length = int(prevsong['time'])
                         time_diff = song_length - time_elapsed
                         if abs(time_diff) < 5 or abs(time_diff) > song_length:
-                            logging.debug("album changed detected: prev: {0} curr: {1}, time_diff: {2}-{3}={4}".format(prevsong['album'],
-                                currsong['album'], song_length, time_elapsed, time_diff))
+                            logging.debug("album changed detected: prev: %s curr: %s, time_diff: %s-%s=%s", prevsong['album'],
+                                currsong['album'], song_length, time_elapsed, time_diff)
                             albumlist.play_next_album(prevsong['album'])
                         else:
-                            logging.debug("user changed song at end of album; not selecting a different album, time_diff: {0}-{1}={2}".format(song_length,
-                                time_elapsed, time_diff))
+                            logging.debug("user changed song at end of album; not selecting a different album, time_diff: %s-%s=%s",
+                                song_length, time_elapsed, time_diff)
                     else:
                         albumlist.play_next_album(prevsong['album'])
                 # update the start time for the next song
                 time_song_start = time.time()
 
-        except:
+        except MPD_CONNECTION_ERRORS:
+            # the connection is gone; leave reconnecting to the caller
+            raise
+        except Exception:
             logging.error("Unexpected error: {}\n{}".format(sys.exc_info()[0], traceback.format_exc()))
             albumlist.play_next_album()
 
@@ -232,10 +261,12 @@ def connect_mpd():
     return client
 
 
-def go_mpd(client, is_daemon):
+def go_mpd(client, is_daemon, rpc_client=None):
     """Top-level function, called from main(). Here is where we start to interact with mpd.
+    If rpc_client is given the album list is loaded and played through it; the MPD client is
+    then only used to watch for track changes.
     """
-    albumlist = AlbumList(client)
+    albumlist = AlbumList(rpc_client or client)
     albumlist.refresh()
     if is_daemon:
         idle_loop(client, albumlist)
@@ -245,10 +276,10 @@ def go_mpd(client, is_daemon):
     client.disconnect()
 
 
-def mpd_info(client):
+def mpd_info(client, rpc_client=None):
     """Print some basic info obtained from mpd.
     """
-    albumlist = AlbumList(client)
+    albumlist = AlbumList(rpc_client or client)
     albumlist.refresh()
     print("Album List:\n")
     albumlist.print_debug_info()
@@ -261,7 +292,7 @@ def mpd_info(client):
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hDpdi", ["help", "debug", "passive", "daemon", "info"])
+        opts, args = getopt.getopt(sys.argv[1:], "hDpdir:", ["help", "debug", "passive", "daemon", "info", "rpc="])
     except getopt.GetoptError:
         # print help information and exit:
         script_help()
@@ -269,6 +300,7 @@ def main():
     arg_daemon=False
     arg_loglevel = logging.INFO
     arg_info = False
+    arg_rpc_url = MOPIDY_RPC_URL
     for o, a in opts:
         if o in ("-h", "--help"):
             script_help()
@@ -281,17 +313,103 @@ def main():
             arg_info = True
         elif o in ("-d", "--daemon"):
             arg_daemon = True
+        elif o in ("-r", "--rpc"):
+            arg_rpc_url = a
     # configure logging
     logging.basicConfig(level=arg_loglevel)
     client = connect_mpd()
+    rpc_client = None
+    if arg_rpc_url:
+        logging.debug("Using Mopidy JSON-RPC at {}".format(arg_rpc_url))
+        rpc_client = MopidyRpcClient(arg_rpc_url)
     if PASSIVE_MODE:
         print("PASSIVE_MODE: will not change playlist")
     if arg_info:
-        return mpd_info(client)
-    go_mpd(client, arg_daemon)
+        return mpd_info(client, rpc_client)
+    go_mpd(client, arg_daemon, rpc_client)
     return 0
 
 
+class MopidyRpcError(Exception):
+    """An error response from the Mopidy JSON-RPC API."""
+
+
+class MopidyRpcClient:
+    """Talks to Mopidy's core API over HTTP JSON-RPC.
+
+    Provides the subset of the MPDClient interface used by AlbumList (status, playlistinfo and
+    play), returning entries shaped like the MPD protocol ones so the rest of the script is unchanged.
+    """
+    def __init__(self, url):
+        self._url = url
+        self._request_id = 0
+        # tlid for each tracklist position, as of the last playlistinfo()
+        self._tlids = []
+
+    def _call_batch(self, calls):
+        """Sends a list of (method, params) calls as one JSON-RPC batch request.
+        Returns the list of results, in the same order as calls.
+        """
+        requests = []
+        for method, params in calls:
+            self._request_id += 1
+            requests.append({'jsonrpc': '2.0', 'id': self._request_id, 'method': method, 'params': params})
+        request = urllib.request.Request(self._url, data=json.dumps(requests).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=MOPIDY_RPC_TIMEOUT) as response:
+            replies = json.loads(response.read().decode('utf-8'))
+        replies_by_id = {reply.get('id'): reply for reply in replies}
+        results = []
+        for r in requests:
+            reply = replies_by_id.get(r['id'])
+            if reply is None:
+                raise MopidyRpcError("No reply to {}".format(r['method']))
+            if 'error' in reply:
+                raise MopidyRpcError("{} failed: {}".format(r['method'], reply['error']))
+            results.append(reply['result'])
+        return results
+
+    @staticmethod
+    def _to_playlist_entry(pos, tl_track):
+        """Converts a Mopidy TlTrack into an MPD style playlist entry. Keys are only present
+        if Mopidy has a value for them, like MPD.
+        """
+        track = tl_track['track']
+        entry = {'file': track['uri'], 'pos': str(pos), 'id': str(tl_track['tlid'])}
+        if track.get('name'):
+            entry['title'] = track['name']
+        if track.get('artists'):
+            entry['artist'] = track['artists'][0].get('name', '')
+        if track.get('album', {}).get('name'):
+            entry['album'] = track['album']['name']
+        if track.get('length'):
+            entry['time'] = str(track['length'] // 1000)
+        if track.get('track_no'):
+            entry['track'] = str(track['track_no'])
+        if track.get('date'):
+            entry['date'] = track['date']
+        if track.get('genre'):
+            entry['genre'] = track['genre']
+        return entry
+
+    def status(self):
+        """Returns the tracklist version and length, as MPD would in status."""
+        version, length = self._call_batch([('core.tracklist.get_version', {}),
+                                            ('core.tracklist.get_length', {})])
+        return {'playlist': str(version), 'playlistlength': str(length)}
+
+    def playlistinfo(self):
+        """Returns the whole tracklist as MPD style playlist entries."""
+        tl_tracks, = self._call_batch([('core.tracklist.get_tl_tracks', {})])
+        self._tlids = [tl_track['tlid'] for tl_track in tl_tracks]
+        return [self._to_playlist_entry(pos, tl_track) for pos, tl_track in enumerate(tl_tracks)]
+
+    def play(self, pos):
+        """Plays the track at the given tracklist position, by its tlid."""
+        self._call_batch([('core.playback.play', {'tlid': self._tlids[int(pos)]})])
+
+
+
 class AlbumList:
     """Manages album information as queried from MPD.
     """
@@ -301,6 +419,7 @@ class AlbumList:
         self._albums = []
         self._last_song_pos = {}
         self._first_song_pos = {}
+        self._fingerprint = None
         if not os.path.exists(MPD_RANDOM_ALBUM_QUEUE_FILE):
             logging.info("Creating album queue file '{}'".format(MPD_RANDOM_ALBUM_QUEUE_FILE))
             self._write_album_queue([])
@@ -311,19 +430,24 @@ class AlbumList:
         #{'file': 'file:///mnt/htpc/store/music/collection/rips/uber/Bob%20Dylan%20-%201966%20-%20Blonde%20on%20Blonde/01%20-%20Rainy%20Day%20Women%20%2312%20%26%2035.mp3', 'time': '276', 'artist': 'Bob Dylan', 'album': 'Blonde on Blonde', 'title': 'Rainy Day Women #12 & 35', 'date': '1966', 'track': '1', 'pos': '140', 'id': '9164', 'genre': 'Folk'}, 
         #logging.debug("playlistinfo: {}".format(self._pl_info))
 
+        self._albums = []
+        self._last_song_pos = {}
+        self._first_song_pos = {}
         last_entry = None
         for pl_entry in self._pl_info:
-            try:
-                if pl_entry['album'] not in self._albums:
+            if 'album' not in pl_entry:
+                logging.debug("_parse_playlist_info, no album key, ignoring entry: %s", pl_entry)
+                continue
+            if last_entry is None or pl_entry['album'] != last_entry['album']:
+                # start of a new run of album entries; the previous run ends at last_entry
+                if last_entry is not None:
+                    self._last_song_pos[last_entry['album']] = last_entry['pos']
+                if pl_entry['album'] not in self._first_song_pos:
                     self._albums.append(pl_entry['album'])
-                    if last_entry:
-                        # pick pos from last entry that is returned
-                        self._last_song_pos[last_entry['album']] = last_entry['pos']
-                        self._first_song_pos[pl_entry['album']] = pl_entry['pos']
-                else:
-                    last_entry = pl_entry
-            except KeyError:
-                logging.debug("_parse_playlist_info, no album key, ignoring entry: {}".format(pl_entry))
+                    self._first_song_pos[pl_entry['album']] = pl_entry['pos']
+            last_entry = pl_entry
+        if last_entry is not None:
+            self._last_song_pos[last_entry['album']] = last_entry['pos']
 
     def _choose_random_album(self, current_album_name):
         """Selects a random album from the current playlist, doing its best to avoid choosing
@@ -392,13 +516,39 @@ class AlbumList:
         logging.info("Album queue: No matching album found from '{}'".format(MPD_RANDOM_ALBUM_QUEUE_FILE))
         return None
 
+    def _tracklist_fingerprint(self):
+        """Returns a cheap value which changes whenever the tracklist changes.
+        Mopidy reports its tracklist version as 'playlist' in status. If that is missing we fall
+        back to the playlist length plus the files at a few sampled positions.
+        """
+        status = self._client.status()
+        if 'playlist' in status:
+            return status['playlist']
+        length = int(status.get('playlistlength', 0))
+        sampled = [self._client.playlistinfo(pos)[0].get('file') for pos in sorted({0, length // 2, length - 1})
+                   if length > 0]
+        return (length,) + tuple(sampled)
+
     def refresh(self):
         """Refreshes the album list.
         """
         logging.info("Resyncing from the current playlist")
+        self._fingerprint = self._tracklist_fingerprint()
         self._pl_info = self._client.playlistinfo()
         self._parse_playlist_info()
 
+    def refresh_if_changed(self):
+        """Refreshes the album list only if the tracklist has changed since the last refresh.
+        Mopidy never sends 'playlist' idle events, so this is checked on each 'player' wakeup.
+        Returns True if a refresh was done.
+        """
+        fingerprint = self._tracklist_fingerprint()
+        if fingerprint == self._fingerprint:
+            return False
+        logging.info("Tracklist changed ({} -> {})".format(self._fingerprint, fingerprint))
+        self.refresh()
+        return True
+
     def get_album_names(self):
         """Returns list of album names.
         """
@@ -410,19 +560,19 @@ class AlbumList:
         if currentsong == None or len(currentsong) < 1:
             return False
         if 'album' not in currentsong:
-            logging.info("current song has no album, ignoring: {}".format(currentsong))
+            logging.info("current song has no album, ignoring: %s", currentsong)
             return False
         try:
             if currentsong['pos'] == self._last_song_pos[currentsong['album']]:
-                logging.info("is last song: {}".format(song_info(currentsong)))
+                logging.info("is last song: %s", song_info(currentsong))
                 return True
         except KeyError:
-            logging.error("Caught KeyError current pos: {}, currentsong['album']: {}".format(currentsong['pos'],
-                                                                                             currentsong['album']))
+            logging.error("Caught KeyError current pos: %s, currentsong['album']: %s", currentsong['pos'],
+                          currentsong['album'])
             return False
-        logging.debug("not last song: {}, current pos: {} / last pos: {}".format(song_info(currentsong),
-                                                                                 currentsong['pos'],
-                                                                                 self._last_song_pos[currentsong['album']]))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("not last song: %s, current pos: %s / last pos: %s", song_info(currentsong),
+                          currentsong['pos'], self._last_song_pos[currentsong['album']])
         return False
 
     def play_next_album(self, current_album_name=None):
@@ -35,10 +35,29 @@ Options:
                    a new random album from the playlist
     -D|--debug   : Print debug messages to stdout
     -p|--passive : Testing only. Does not make any changes to the MPD playlist.
+    -j|--jobs N  : Open N extra MPD connections and fetch the playlist over them in
+                   parallel on refresh [default=$MPD_RANDOM_FETCH_CONNECTIONS or 0].
+                   Helps with large playlists when MPD is on another host.
+    -s|--score   : Weighted random selection instead of uniform random. Albums are scored
+                   on how long ago they were last picked, how often they have been picked,
+                   their length and their genre (see Scored Selection below). Requires numpy.
+    -t|--time-budget MINUTES : Only pick albums which are no longer than MINUTES
+                   [default=$MPD_RANDOM_TIME_BUDGET]. Falls back to any album if none fit.
+    -i|--info    : Print the album list, and how much time is left in the current album
+                   and in the playlist.
+    -P|--profile : Time refresh, album selection, album queue processing and every MPD
+                   command, and log a summary on exit (or on SIGUSR1).
+    --profile-file FILE : Profile as -P, and also run cProfile and write its stats to FILE
+                   (view with: python -m pstats FILE).
+    -m|--multiroom ROOMS : Multi-room daemon mode. ROOMS is a comma-separated list of MPD
+                   instances as [password@]host[:port] [default=$MPD_RANDOM_ROOMS]. At the
+                   end of an album in any room, the next album is chosen once (from the
+                   first room's playlist) and started in every room at the same moment.
 
 Dependencies:
 
 * python2-mpd  : still using the python2 mpd library (for now)
+* numpy        : optional, only needed for -s|--score
 
 Limitations:
 
@@ -62,13 +81,61 @@ Album names are consumed as a queue, until the file is empty, after which the se
 revert back to random.
 
 By default, the given album string matches the first album against any
-substring in the playlist album names (case-sensitive). For an exact match,
-prefix the album name with a '!'.
+substring in the playlist album names. Matching ignores case, accents and
+punctuation, e.g. 'sgt peppers' matches "Sgt. Pepper's Lonely Hearts Club Band"
+and 'velvet' matches 'Velvét Underground & Nico'. For an exact match, prefix
+the album name with a '!'. For a fuzzy match, prefix the album name with a '~';
+the most similar album name is chosen, provided its similarity (0 to 1) is at
+least $MPD_RANDOM_FUZZY_THRESHOLD [default=0.3].
 
 An example /tmp/mpd.albumq:
 
     Abbey Road
     !Movement (Remastered)
+    ~dark side of teh moon
+
+
+### Scored Selection
+
+With -s|--score each album gets a score, and the next album is sampled with probability
+proportional to exp(score). The score is a weighted sum of:
+
+    recency   : log(1 + hours since the album was last picked by this script)
+    playcount : -log(1 + number of times the album has been picked)
+    length    : log(number of songs in the album)
+
+The weights are given by MPD_RANDOM_SCORE_WEIGHTS [default=recency=1,playcount=1,length=0].
+Genres can be made more or less likely with a multiplier in MPD_RANDOM_GENRE_WEIGHTS,
+e.g. MPD_RANDOM_GENRE_WEIGHTS='Jazz=2,Christmas=0'. Play history is kept in memory only.
+
+
+### Prefetching From Slow Storage
+
+If MPD_RANDOM_MUSIC_DIR is set to MPD's music_directory (e.g. an NFS mount), then in daemon
+mode the next album is chosen as soon as the last song of the current album starts, and its
+files are read into the page cache by a background thread so that the next album starts
+without waiting on cold reads. At most MPD_RANDOM_PREFETCH_BYTES [default=536870912] are
+prefetched per album. The staged album is dropped if the playlist changes or the user moves
+away from the last song, and an album queue entry is only consumed once its album starts.
+
+
+### Single Instance
+
+In daemon mode the script takes an exclusive lock on the file given by environment variable
+MPD_RANDOM_LOCK_FILE [default=/tmp/mpd-random-playlist-album.pid] and writes its pid to it.
+If another daemon already holds the lock the script exits with status 3.
+
+
+### Multi-room
+
+With -m|--multiroom, one daemon watches several MPD instances at once, e.g.
+
+    ./mpd-random-playlist-album.py -m livingroom,kitchen:6601,secret@study
+
+When an album ends in any room the next album is chosen once, from the playlist of the first
+room, and all rooms are told to play it at the same moment. Each room must have the album in
+its playlist, although not necessarily at the same position. The spread between the rooms'
+start times is logged after each switch.
 
 
 ### Temporarily Suspend (mpd.norandom file)
@@ -94,16 +161,36 @@ Start a daemon, logging output to /tmp/mpd-random-playlist-album.log
     (./mpd-random-playlist-album.py -d > /tmp/mpd-random-playlist-album.log 2>&1 ) &
 """
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import fcntl
+import functools
 import getopt
 import logging
 import mpd
 import os
 import os.path
+import queue
 import random
+import re
+import signal
+import socket
 import sys
 import tempfile
+import threading
 import time
 import traceback
+import unicodedata
+import urllib.parse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # If this file exists then no random album is chosen. Used to easily disable the daemon
 # e.g. touch /tmp/mpd.norandom && sleep 3600 && rm -f /tmp/mpd.norandom
@@ -130,15 +217,128 @@ MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE = os.getenv('MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_
 if MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE is None:
     MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE = MPD_RANDOM_ALBUM_QUEUE_FILE + '.archive'
 
+# Number of extra MPD connections used to fetch the playlist in parallel on refresh.
+# 0 fetches everything serially over the main connection. Overridden by the -j option.
+MPD_RANDOM_FETCH_CONNECTIONS = int(os.getenv('MPD_RANDOM_FETCH_CONNECTIONS', '0'))
+
+# Number of playlist entries requested per playlistinfo call when fetching in parallel.
+MPD_RANDOM_FETCH_WINDOW = int(os.getenv('MPD_RANDOM_FETCH_WINDOW', '1000'))
+
+# Weights for the -s|--score album selector, as comma-separated name=value pairs.
+MPD_RANDOM_SCORE_WEIGHTS = os.getenv('MPD_RANDOM_SCORE_WEIGHTS', 'recency=1,playcount=1,length=0')
+
+# Per-genre selection multipliers for the -s|--score album selector, e.g. 'Jazz=2,Christmas=0'.
+MPD_RANDOM_GENRE_WEIGHTS = os.getenv('MPD_RANDOM_GENRE_WEIGHTS', '')
+
+# Minimum similarity (0 to 1) for a fuzzy '~' album queue match
+MPD_RANDOM_FUZZY_THRESHOLD = float(os.getenv('MPD_RANDOM_FUZZY_THRESHOLD', '0.3'))
+
+# MPD's music_directory. If set, the files of the next album are prefetched into the page cache
+# before it starts playing (daemon mode only).
+MPD_RANDOM_MUSIC_DIR = os.getenv('MPD_RANDOM_MUSIC_DIR')
+
+# Maximum number of bytes to prefetch for an album
+MPD_RANDOM_PREFETCH_BYTES = int(os.getenv('MPD_RANDOM_PREFETCH_BYTES', str(512 * 1024 * 1024)))
+
+# Lock file held while running in daemon mode, so that only one daemon runs at a time.
+# Contains the pid of the running daemon.
+MPD_RANDOM_LOCK_FILE = os.getenv('MPD_RANDOM_LOCK_FILE')
+if MPD_RANDOM_LOCK_FILE is None:
+    MPD_RANDOM_LOCK_FILE = os.path.join(tempfile.gettempdir(), 'mpd-random-playlist-album.pid')
+
+# Exit status used when another daemon already holds MPD_RANDOM_LOCK_FILE
+EXIT_ALREADY_RUNNING = 3
+
+# Comma-separated list of MPD instances for multi-room mode, as [password@]host[:port].
+# Overridden by the -m option.
+MPD_RANDOM_ROOMS = os.getenv('MPD_RANDOM_ROOMS')
+
+# Only pick albums with a total length up to this many minutes. Overridden by the -t option.
+MPD_RANDOM_TIME_BUDGET = os.getenv('MPD_RANDOM_TIME_BUDGET')
+if MPD_RANDOM_TIME_BUDGET is not None:
+    MPD_RANDOM_TIME_BUDGET = float(MPD_RANDOM_TIME_BUDGET)
+
+# Errors raised when the connection to mpd is lost: mpd's own, and the socket level ones
+MPD_CONNECTION_ERRORS = (mpd.ConnectionError, ConnectionError, socket.timeout)
+
 # This is used for testing purposes
 PASSIVE_MODE = False
 
+# Set by the -P option, see Profiler
+PROFILER = None
+
 
 def script_help():
     print(__doc__)
     sys.exit(-1)
 
 
+class Profiler:
+    """Accumulates wall clock timings of named spans: album list refresh and its phases, album
+    selection, album queue processing and each MPD command (as 'mpd.<command>').
+    """
+    def __init__(self):
+        self._spans = {}
+        # reentrant, as report() runs from the SIGUSR1 handler, possibly inside span()
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - time_start
+            with self._lock:
+                count, total, longest = self._spans.get(name, (0, 0.0, 0.0))
+                self._spans[name] = (count + 1, total + elapsed, max(longest, elapsed))
+
+    def report(self):
+        """Logs the accumulated timings, largest total first.
+        """
+        with self._lock:
+            spans = sorted(self._spans.items(), key=lambda item: item[1][1], reverse=True)
+        lines = ["{:<32} {:>8} {:>12} {:>12} {:>12}".format('span', 'count', 'total ms', 'mean ms', 'max ms')]
+        for name, (count, total, longest) in spans:
+            lines.append("{:<32} {:>8} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                name, count, total * 1000, total * 1000 / count, longest * 1000))
+        logging.info("Profile:\n%s", '\n'.join(lines))
+
+
+def profiled(name):
+    """Decorator which times each call of the function as a Profiler span, if profiling is on.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if PROFILER is None:
+                return func(*args, **kwargs)
+            with PROFILER.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfiledClient:
+    """Wraps an MPDClient so that every command is timed as a Profiler span.
+    """
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        return profiled('mpd.' + name)(attr)
+
+
+def format_duration(seconds):
+    """Formats a number of seconds as H:MM:SS.
+    """
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
 def song_info(song):
     """A helper to format song info.
     """
@@ -148,17 +348,57 @@ def song_info(song):
         return "[{}-{}]".format(song['artist'], song['album'])
 
 
-def idle_loop(client, albumlist):
+def normalize_album_name(name):
+    """Returns name casefolded, with accents, apostrophes and other punctuation removed and
+    whitespace collapsed.
+    """
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c) and c not in "'\u2019`")
+    return ' '.join(w for w in re.split(r'[\W_]+', stripped.casefold()) if w)
+
+
+def parse_weights(spec):
+    """Parses a 'name=value,name=value' string into a dict of floats.
+    """
+    weights = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, value = item.rsplit('=', 1)
+        try:
+            weights[name.strip()] = float(value)
+        except ValueError:
+            logging.warning("Ignoring invalid weight '{}'".format(item))
+    return weights
+
+
+def idle_loop(client, albumlist, on_album_end=None):
     """MPD idle loop.  Used when we're in daemon mode.
+    on_album_end(album_name) is called at the end of an album [default=albumlist.play_next_album].
     """
+    if on_album_end is None:
+        on_album_end = albumlist.play_next_album
     time_song_start = time.time()
     while 1:
-        logging.debug("idle_loop: current song: {}".format(client.currentsong()))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("idle_loop: current song: %s", client.currentsong())
         try:
             prevsong = client.currentsong()
             at_last_song = albumlist.is_last_song_in_album(prevsong)
+            try:
+                if at_last_song:
+                    # choose the next album now so its files can be prefetched (if enabled)
+                    albumlist.stage_next_album(prevsong['album'])
+                else:
+                    # the album didn't end from the last song; choose again when it does
+                    albumlist.unstage_next_album()
+            except MPD_CONNECTION_ERRORS:
+                raise
+            except Exception:
+                # not the end of the album: the album is chosen again when it does end
+                logging.error("Failed to stage the next album: {}\n{}".format(sys.exc_info()[0], traceback.format_exc()))
             reasons = client.idle('player','playlist') # blocking
-            logging.debug("response from client.idle: {}".format(str(reasons)))
+            logging.debug("response from client.idle: %s", reasons)
 
             # streams come in with ['playlist', 'player'] on song change
             # we only want to refresh the albumlist if only the playlist has changed:
@@ -180,9 +420,10 @@ def idle_loop(client, albumlist):
             if currsong == None or len(currsong) < 1:
                 # handle end of playlist
                 logging.info("end of playlist detected")
-                albumlist.play_next_album(prevsong['album'])
+                on_album_end(prevsong['album'])
             elif currsong['pos'] != prevsong['pos']:
-                logging.debug("song change detected: prev: {} curr: {}".format(song_info(prevsong), song_info(currsong)))
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("song change detected: prev: %s curr: %s", song_info(prevsong), song_info(currsong))
                 if currsong['album'] != prevsong['album']:
                     # Check that we are at the end of the last song. This is to handle the case where the user
                     # changes the current song when we're at the last song in an album
@@ -191,36 +432,53 @@ def idle_loop(client, albumlist):
                         song_length = int(prevsong['time'])
                         time_diff = song_length - time_elapsed
                         if abs(time_diff) < 5 or abs(time_diff) > song_length:
-                            logging.debug("album changed detected: prev: {0} curr: {1}, time_diff: {2}-{3}={4}".format(prevsong['album'],
-                                currsong['album'], song_length, time_elapsed, time_diff))
-                            albumlist.play_next_album(prevsong['album'])
+                            logging.debug("album changed detected: prev: %s curr: %s, time_diff: %s-%s=%s", prevsong['album'],
+                                currsong['album'], song_length, time_elapsed, time_diff)
+                            on_album_end(prevsong['album'])
                         else:
-                            logging.debug("user changed song at end of album; not selecting a different album, time_diff: {0}-{1}={2}".format(song_length,
-                                time_elapsed, time_diff))
+                            logging.debug("user changed song at end of album; not selecting a different album, time_diff: %s-%s=%s",
+                                song_length, time_elapsed, time_diff)
                     else:
-                        albumlist.play_next_album(prevsong['album'])
+                        on_album_end(prevsong['album'])
                 # update the start time for the next song
                 time_song_start = time.time()
 
-        except:
+        except MPD_CONNECTION_ERRORS:
+            # the connection is gone; leave reconnecting to the caller
+            raise
+        except Exception:
             logging.error("Unexpected error: {}\n{}".format(sys.exc_info()[0], traceback.format_exc()))
-            albumlist.play_next_album()
+            on_album_end()
 
 
-def connect_mpd():
-    """Connect to mpd.
+def parse_room(room):
+    """Parses a [password@]host[:port] room spec into (host, port, password).
     """
-    client = mpd.MPDClient()
     mpd_passwd = None
-    mpd_host = os.getenv('MPD_HOST')
+    mpd_port = 6600
+    splithost = room.split('@')
+    if len(splithost) > 1:
+        mpd_passwd = splithost[0]
+    mpd_host = splithost[-1]
+    if not mpd_host.startswith('/') and ':' in mpd_host:
+        mpd_host, mpd_port = mpd_host.rsplit(':', 1)
+    return mpd_host, mpd_port, mpd_passwd
+
+
+def connect_mpd(mpd_host=None, mpd_port=None, mpd_passwd=None):
+    """Connect to mpd. Uses MPD_HOST and MPD_PORT unless a host is given.
+    """
+    client = mpd.MPDClient()
     if mpd_host is None:
-        mpd_host = 'localhost'
-    else:
-        splithost = mpd_host.split('@')
-        if len(splithost) > 1:
-            mpd_passwd = splithost[0]
-            mpd_host = splithost[1]
-    mpd_port = os.getenv('MPD_PORT')
+        mpd_host = os.getenv('MPD_HOST')
+        if mpd_host is None:
+            mpd_host = 'localhost'
+        else:
+            splithost = mpd_host.split('@')
+            if len(splithost) > 1:
+                mpd_passwd = splithost[0]
+                mpd_host = splithost[1]
+        mpd_port = os.getenv('MPD_PORT')
     if mpd_port is None:
         mpd_port = 6600
     client.connect(mpd_host, mpd_port)
@@ -228,39 +486,113 @@ def connect_mpd():
         client.password(mpd_passwd)
     logging.debug("MPD version: {}".format(client.mpd_version))
     #logging.debug("client.commands(): %s" % client.commands())
+    if PROFILER is not None:
+        return ProfiledClient(client)
     return client
 
 
-def go_mpd(client, is_daemon):
+def acquire_daemon_lock():
+    """Takes an exclusive lock on MPD_RANDOM_LOCK_FILE and writes our pid into it.
+    Returns the lock file, which must be kept open for as long as we run, or None if
+    another daemon already holds the lock.
+    """
+    lock_file = open(MPD_RANDOM_LOCK_FILE, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock_file.seek(0)
+        logging.error("Already running with pid {} (lock file '{}')".format(lock_file.read().strip(),
+                                                                             MPD_RANDOM_LOCK_FILE))
+        lock_file.close()
+        return None
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write("{}\n".format(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+
+def create_pool(size):
+    """Returns a ConnectionPool of the given size, or None if size is 0.
+    """
+    if size < 1:
+        return None
+    if MPD_RANDOM_FETCH_WINDOW < 1:
+        logging.error("MPD_RANDOM_FETCH_WINDOW must be at least 1, not {}".format(MPD_RANDOM_FETCH_WINDOW))
+        sys.exit(1)
+    logging.debug("Opening {} extra MPD connections for parallel fetch".format(size))
+    return ConnectionPool(size)
+
+
+def create_prefetcher():
+    """Returns a Prefetcher if MPD_RANDOM_MUSIC_DIR is configured, otherwise None.
+    """
+    if not MPD_RANDOM_MUSIC_DIR:
+        return None
+    logging.debug("Prefetching up to {} bytes per album from '{}'".format(MPD_RANDOM_PREFETCH_BYTES,
+                                                                       MPD_RANDOM_MUSIC_DIR))
+    return Prefetcher(MPD_RANDOM_MUSIC_DIR, MPD_RANDOM_PREFETCH_BYTES)
+
+
+def create_scorer(use_score):
+    """Returns an AlbumScorer if scored selection was asked for, otherwise None.
+    """
+    if not use_score:
+        return None
+    if numpy is None:
+        logging.warning("numpy is not installed, falling back to uniform random selection")
+        return None
+    return AlbumScorer(parse_weights(MPD_RANDOM_SCORE_WEIGHTS), parse_weights(MPD_RANDOM_GENRE_WEIGHTS))
+
+
+def go_mpd(client, is_daemon, pool=None, scorer=None):
     """Top-level function, called from main(). Here is where we start to interact with mpd.
     """
-    albumlist = AlbumList(client)
+    albumlist = AlbumList(client, pool, scorer, create_prefetcher() if is_daemon else None)
     albumlist.refresh()
     if is_daemon:
         idle_loop(client, albumlist)
     else:
         albumlist.play_next_album()
+    if pool is not None:
+        pool.close()
     client.close()
     client.disconnect()
 
 
-def mpd_info(client):
+def go_multiroom(rooms, scorer=None):
+    """Top-level function for multi-room mode, called from main(). Runs until interrupted.
+    """
+    MultiRoom([parse_room(room) for room in rooms.split(',') if room.strip()], scorer).run()
+
+
+def mpd_info(client, pool=None):
     """Print some basic info obtained from mpd.
     """
-    albumlist = AlbumList(client)
+    albumlist = AlbumList(client, pool)
     albumlist.refresh()
+    if pool is not None:
+        pool.close()
     print("Album List:\n")
     albumlist.print_debug_info()
     print("\nCurrent Song:\n")
     currsong = client.currentsong()
     print(currsong)
+    status = client.status()
+    if 'song' in status:
+        pos = int(status['song'])
+        elapsed = float(status.get('elapsed', 0))
+        print("\nTime left in album: {}".format(format_duration(albumlist.time_left_in_album(pos, elapsed))))
+        print("Time left in playlist: {}".format(format_duration(albumlist.time_left_in_queue(pos, elapsed))))
     client.close()
     client.disconnect()
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hDpdi", ["help", "debug", "passive", "daemon", "info"])
+        opts, args = getopt.getopt(sys.argv[1:], "hDpdij:sm:t:P", ["help", "debug", "passive", "daemon", "info", "jobs=", "score",
+                                                              "multiroom=", "time-budget=", "profile",
+                                                              "profile-file="])
     except getopt.GetoptError:
         # print help information and exit:
         script_help()
@@ -268,6 +600,11 @@ def main():
     arg_daemon=False
     arg_loglevel = logging.INFO
     arg_info = False
+    arg_jobs = MPD_RANDOM_FETCH_CONNECTIONS
+    arg_score = False
+    arg_rooms = MPD_RANDOM_ROOMS
+    arg_profile = False
+    arg_profile_file = None
     for o, a in opts:
         if o in ("-h", "--help"):
             script_help()
@@ -280,69 +617,632 @@ def main():
             arg_info = True
         elif o in ("-d", "--daemon"):
             arg_daemon = True
+        elif o in ("-j", "--jobs"):
+            try:
+                arg_jobs = int(a)
+            except ValueError:
+                script_help()
+        elif o in ("-s", "--score"):
+            arg_score = True
+        elif o in ("-m", "--multiroom"):
+            arg_rooms = a
+        elif o in ("-t", "--time-budget"):
+            global MPD_RANDOM_TIME_BUDGET
+            try:
+                MPD_RANDOM_TIME_BUDGET = float(a)
+            except ValueError:
+                script_help()
+        elif o in ("-P", "--profile"):
+            arg_profile = True
+        elif o == "--profile-file":
+            arg_profile = True
+            arg_profile_file = a
     # configure logging
     logging.basicConfig(level=arg_loglevel)
-    client = connect_mpd()
+    if not arg_profile:
+        return run(arg_daemon, arg_info, arg_jobs, arg_score, arg_rooms)
+    global PROFILER
+    PROFILER = Profiler()
+    # make sure we get to report when stopped as a daemon
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: PROFILER.report())
+    profile = cProfile.Profile() if arg_profile_file else None
+    if profile is not None:
+        profile.enable()
+    try:
+        return run(arg_daemon, arg_info, arg_jobs, arg_score, arg_rooms)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(arg_profile_file)
+            logging.info("Wrote cProfile stats to '%s'", arg_profile_file)
+        PROFILER.report()
+
+
+def run(arg_daemon, arg_info, arg_jobs, arg_score, arg_rooms):
+    """Runs the selected mode, once options are parsed and logging is configured.
+    """
+    if arg_daemon or arg_rooms:
+        lock_file = acquire_daemon_lock()
+        if lock_file is None:
+            return EXIT_ALREADY_RUNNING
     if PASSIVE_MODE:
         print("PASSIVE_MODE: will not change playlist")
+    if arg_rooms and not arg_info:
+        go_multiroom(arg_rooms, create_scorer(arg_score))
+        return 0
+    client = connect_mpd()
+    pool = create_pool(arg_jobs)
     if arg_info:
-        return mpd_info(client)
-    go_mpd(client, arg_daemon)
+        return mpd_info(client, pool)
+    go_mpd(client, arg_daemon, pool, create_scorer(arg_score))
     return 0
 
 
+class ConnectionPool:
+    """A small pool of extra MPD connections, used to run independent queries concurrently.
+    """
+    def __init__(self, size, connect=None):
+        # connect returns a new client; used by the benchmark to pool mock clients
+        self._connect = connect or connect_mpd
+        self._clients = queue.Queue()
+        for i in range(size):
+            self._clients.put(self._connect())
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+        self.size = size
+
+    def _call(self, command, args):
+        """Runs a single command on the next free connection, reconnecting once if it was dropped.
+        """
+        client = self._clients.get()
+        try:
+            try:
+                return getattr(client, command)(*args)
+            except (mpd.ConnectionError, socket.error):
+                # mpd drops connections which have been unused for longer than its connection_timeout
+                logging.debug("ConnectionPool: reconnecting dropped connection")
+                try:
+                    client.disconnect()
+                except (mpd.ConnectionError, socket.error):
+                    pass
+                client = self._connect()
+                return getattr(client, command)(*args)
+        finally:
+            self._clients.put(client)
+
+    def map(self, command, arg_list):
+        """Runs command once per args tuple in arg_list, spread over the pool.
+        Returns the results in the same order as arg_list.
+        """
+        return list(self._executor.map(lambda args: self._call(command, args), arg_list))
+
+    def close(self):
+        self._executor.shutdown()
+        while not self._clients.empty():
+            client = self._clients.get()
+            try:
+                client.close()
+                client.disconnect()
+            except (mpd.ConnectionError, socket.error):
+                pass
+
+
+class MultiRoom:
+    """Plays the same album in several MPD instances ("rooms") at the same moment.
+
+    Each room is watched from its own thread with idle_loop. When an album ends in any room the
+    next album is chosen once, from the first room's AlbumList, and started in every room in
+    parallel. The play commands are released together by a barrier once every room has looked
+    up the album's position in its own playlist.
+    """
+    # seconds to wait before reconnecting to a room after an error
+    RECONNECT_DELAY = 5
+    # seconds to wait for all rooms to be ready to play
+    SYNC_TIMEOUT = 10
+
+    def __init__(self, rooms, scorer=None):
+        self._rooms = rooms
+        self._scorer = scorer
+        self._primary = None
+        self._current_album = None
+        self._lock = threading.Lock()
+
+    def _room_name(self, room):
+        return "{}:{}".format(room[0], room[1])
+
+    def _watch(self, room, is_primary):
+        """Thread target: runs idle_loop for a single room, reconnecting after errors.
+        idle_loop raises MPD_CONNECTION_ERRORS when the connection is lost.
+        """
+        while True:
+            client = None
+            try:
+                client = connect_mpd(*room)
+                albumlist = AlbumList(client, scorer=self._scorer if is_primary else None)
+                albumlist.refresh()
+                if is_primary:
+                    self._primary = albumlist
+                idle_loop(client, albumlist, lambda album_name=None: self.album_ended(room, album_name))
+            except MPD_CONNECTION_ERRORS:
+                logging.warning("multiroom: {}: connection lost: {}, reconnecting in {}s".format(
+                    self._room_name(room), sys.exc_info()[1], self.RECONNECT_DELAY))
+            except Exception:
+                logging.error("multiroom: {}: unexpected error: {}\n{}".format(self._room_name(room),
+                              sys.exc_info()[0], traceback.format_exc()))
+            if is_primary:
+                # don't choose albums from a stale playlist while reconnecting
+                self._primary = None
+            if client is not None:
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+            time.sleep(self.RECONNECT_DELAY)
+
+    def album_ended(self, room, album_name):
+        """Called from a room's idle_loop at the end of an album. Every room reports the end of
+        the same album, so only the first report for the album currently playing is acted on.
+        """
+        with self._lock:
+            if album_name is None:
+                # an error in one room should not switch every room
+                logging.info("multiroom: {}: ignoring album change after error".format(self._room_name(room)))
+                return
+            if self._current_album is not None and album_name != self._current_album:
+                logging.debug("multiroom: {}: ignoring end of '{}', now playing '{}'".format(
+                    self._room_name(room), album_name, self._current_album))
+                return
+            if self._primary is None:
+                logging.warning("multiroom: first room is not connected, not choosing next album")
+                return
+            if os.path.exists(MPD_RANDOM_SUSPEND_FILE):
+                logging.info("Suspended by presence of {}, not choosing next album".format(MPD_RANDOM_SUSPEND_FILE))
+                return
+            next_album = self._primary.next_album(album_name)
+            if next_album is None:
+                print("ERROR: could not find an album to play")
+                return
+            self._current_album = next_album
+            self._play_everywhere(next_album)
+
+    def _play_everywhere(self, album_name):
+        """Starts album_name in every room in parallel and logs the spread of start times.
+        """
+        barrier = threading.Barrier(len(self._rooms), timeout=self.SYNC_TIMEOUT)
+
+        def play_room(room):
+            client = None
+            try:
+                # use a fresh connection: mpd drops connections which are idle for too long
+                client = connect_mpd(*room)
+                entries = client.playlistfind("album", album_name)
+                if len(entries) < 1:
+                    print("ERROR: could not find album '{}' in {}".format(album_name, self._room_name(room)))
+                try:
+                    barrier.wait()
+                except threading.BrokenBarrierError:
+                    logging.warning("multiroom: {}: not every room is ready, starting anyway".format(
+                        self._room_name(room)))
+                if len(entries) < 1 or PASSIVE_MODE:
+                    return None
+                client.play(entries[0]['pos'])
+                return time.time()
+            except Exception:
+                barrier.abort()
+                logging.error("multiroom: {}: could not play: {}".format(self._room_name(room), sys.exc_info()[1]))
+            finally:
+                if client is not None:
+                    client.close()
+                    client.disconnect()
+            return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self._rooms)) as executor:
+            started = [t for t in executor.map(play_room, self._rooms) if t is not None]
+        skew = (max(started) - min(started)) * 1000 if started else 0.0
+        logging.info("multiroom: started '{}' in {}/{} rooms, skew {:.1f} ms".format(
+            album_name, len(started), len(self._rooms), skew))
+
+    def run(self):
+        threads = []
+        for i, room in enumerate(self._rooms):
+            thread = threading.Thread(target=self._watch, args=(room, i == 0), name=self._room_name(room))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join with a timeout so that KeyboardInterrupt is delivered
+            while thread.is_alive():
+                thread.join(1)
+
+
+class Prefetcher:
+    """Reads the files of an upcoming album into the page cache from a background thread.
+    """
+    READ_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, music_dir, byte_budget):
+        self._music_dir = music_dir
+        self._byte_budget = byte_budget
+        self._requests = queue.Queue()
+        thread = threading.Thread(target=self._run, name='prefetch')
+        thread.daemon = True
+        thread.start()
+
+    def resolve(self, file_uri):
+        """Returns the local path for a playlist 'file' entry, or None for streams.
+        """
+        if file_uri.startswith('file://'):
+            return urllib.parse.unquote(file_uri[len('file://'):])
+        if '://' in file_uri:
+            return None
+        return os.path.join(self._music_dir, file_uri)
+
+    def prefetch(self, files):
+        """Queues the given playlist 'file' entries for prefetching. Returns immediately.
+        """
+        self._requests.put(list(files))
+
+    def _warm(self, path, size):
+        with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+            else:
+                while f.read(self.READ_CHUNK_SIZE):
+                    pass
+
+    def _run(self):
+        while True:
+            files = self._requests.get()
+            # only the most recent album matters
+            while not self._requests.empty():
+                files = self._requests.get_nowait()
+            budget = self._byte_budget
+            time_start = time.time()
+            for file_uri in files:
+                path = self.resolve(file_uri)
+                if path is None:
+                    continue
+                try:
+                    size = os.path.getsize(path)
+                    if size > budget:
+                        logging.debug("Prefetch: byte budget reached at '{}'".format(path))
+                        break
+                    self._warm(path, size)
+                    budget -= size
+                except (IOError, OSError) as e:
+                    logging.warning("Prefetch: could not read '{}': {}".format(path, e))
+            logging.debug("Prefetch: {} bytes in {:.3f}s".format(self._byte_budget - budget, time.time() - time_start))
+
+
+class AlbumScorer:
+    """Weighted random album selection.
+
+    Per-album features are kept in numpy arrays aligned with the album list, so every album is
+    scored and sampled in a single vectorized pass. The arrays are realigned on each refresh,
+    carrying over the play history of albums which are still in the playlist.
+    """
+    # hours since last pick used for albums which have never been picked
+    NEVER_PICKED_HOURS = 24 * 365
+
+    def __init__(self, weights, genre_weights):
+        self._weights = weights
+        self._genre_weights = genre_weights
+        self._albums = []
+        self._index = {}
+        self._last_picked = numpy.zeros(0)
+        self._pick_count = numpy.zeros(0)
+        self._num_songs = numpy.zeros(0)
+        self._duration = numpy.zeros(0)
+        self._genre_weight = numpy.ones(0)
+
+    def sync(self, albums, plinfo):
+        """Realigns the feature arrays with the given album list and playlist info.
+        """
+        index = {a: i for i, a in enumerate(albums)}
+        old_pos = numpy.array([self._index.get(a, -1) for a in albums], dtype=numpy.intp)
+        kept = old_pos >= 0
+        last_picked = numpy.zeros(len(albums))
+        last_picked[kept] = self._last_picked[old_pos[kept]]
+        pick_count = numpy.zeros(len(albums))
+        pick_count[kept] = self._pick_count[old_pos[kept]]
+
+        song_album_index = []
+        song_times = []
+        genres = {}
+        for entry in plinfo:
+            if 'album' in entry:
+                song_album_index.append(index[entry['album']])
+                song_times.append(float(entry.get('time') or entry.get('duration') or 0))
+                if 'genre' in entry and entry['album'] not in genres:
+                    genres[entry['album']] = entry['genre']
+        song_album_index = numpy.array(song_album_index, dtype=numpy.intp)
+        self._num_songs = numpy.bincount(song_album_index, minlength=len(albums)).astype(float)
+        self._duration = numpy.bincount(song_album_index, weights=song_times, minlength=len(albums))
+        self._genre_weight = numpy.array([self._genre_weights.get(genres.get(a), 1.0) for a in albums])
+        self._albums = albums
+        self._index = index
+        self._last_picked = last_picked
+        self._pick_count = pick_count
+
+    def record_pick(self, album_name):
+        """Updates the play history for the given album.
+        """
+        i = self._index.get(album_name)
+        if i is not None:
+            self._last_picked[i] = time.time()
+            self._pick_count[i] += 1
+
+    def scores(self):
+        """Returns the score of every album, aligned with the album list.
+        """
+        hours = numpy.where(self._last_picked > 0, (time.time() - self._last_picked) / 3600.0,
+                            self.NEVER_PICKED_HOURS)
+        return (self._weights.get('recency', 0.0) * numpy.log1p(hours)
+                - self._weights.get('playcount', 0.0) * numpy.log1p(self._pick_count)
+                + self._weights.get('length', 0.0) * numpy.log(numpy.maximum(self._num_songs, 1)))
+
+    def choose(self, current_album_name, max_duration=None):
+        """Samples an album with probability proportional to exp(score), never choosing the
+        current album. If max_duration is given only albums up to that many seconds long are
+        considered. Returns None if no album has a non-zero weight.
+        """
+        scores = self.scores()
+        if len(scores) < 1:
+            return None
+        weights = numpy.exp(scores - scores.max()) * self._genre_weight
+        if max_duration is not None:
+            weights[self._duration > max_duration] = 0.0
+        if current_album_name in self._index:
+            weights[self._index[current_album_name]] = 0.0
+        cumulative = numpy.cumsum(weights)
+        if cumulative[-1] <= 0:
+            return None
+        i = int(numpy.searchsorted(cumulative, random.random() * cumulative[-1], side='right'))
+        return self._albums[min(i, len(self._albums) - 1)]
+
+
+class AlbumMatchIndex:
+    """Index of normalized album names used to match album queue entries.
+
+    Each normalized name is broken into trigrams, and an inverted index maps each trigram to
+    the playlist positions of the albums containing it, in ascending order. A substring lookup
+    walks the postings of the query's rarest trigram and stops at the first album which really
+    contains the query; a fuzzy lookup ranks a shortlist of albums by trigram similarity. Where
+    more than one album matches, the first one in the playlist is returned, as before.
+    """
+    # A fuzzy lookup counts shared trigrams over at most this many postings entries (but always
+    # at least the rarest trigram's), and computes the similarity of the FUZZY_SHORTLIST albums
+    # sharing the most.
+    FUZZY_POSTINGS_BUDGET = 5000
+    FUZZY_SHORTLIST = 50
+
+    def __init__(self):
+        # per album name, kept across updates
+        self._normalized = {}
+        self._name_trigrams = {}
+        # indexed by playlist position, rebuilt when the order of the albums changes
+        self._albums = []
+        self._albums_normalized = []
+        self._by_normalized = {}
+        self._postings = {}
+
+    @staticmethod
+    def _padded_trigrams(normalized):
+        padded = ' ' + normalized + ' '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @staticmethod
+    def _inner_trigrams(normalized):
+        return {normalized[i:i + 3] for i in range(len(normalized) - 2)}
+
+    def _rarest(self, trigrams):
+        """Returns the given trigrams ordered by the number of albums containing them."""
+        return sorted(trigrams, key=lambda t: len(self._postings.get(t, ())))
+
+    def _append(self, album_name):
+        normalized = self._normalized.get(album_name)
+        if normalized is None:
+            normalized = normalize_album_name(album_name)
+            self._normalized[album_name] = normalized
+            self._name_trigrams[album_name] = self._padded_trigrams(normalized)
+        pos = len(self._albums)
+        self._albums.append(album_name)
+        self._albums_normalized.append(normalized)
+        self._by_normalized.setdefault(normalized, pos)
+        for t in self._name_trigrams[album_name]:
+            self._postings.setdefault(t, []).append(pos)
+
+    def update(self, albums):
+        """Brings the index in line with the given album list. Only albums which were added
+        since the last update are normalized. The postings are extended when albums were only
+        appended, and rebuilt in the new order otherwise.
+        """
+        current = set(albums)
+        for album_name in [a for a in self._normalized if a not in current]:
+            del self._normalized[album_name]
+            del self._name_trigrams[album_name]
+        if albums[:len(self._albums)] != self._albums:
+            self._albums = []
+            self._albums_normalized = []
+            self._by_normalized = {}
+            self._postings = {}
+        for album_name in albums[len(self._albums):]:
+            self._append(album_name)
+
+    def exact(self, query):
+        """Returns the first album whose normalized name equals the normalized query."""
+        pos = self._by_normalized.get(normalize_album_name(query))
+        return self._albums[pos] if pos is not None else None
+
+    def substring(self, query):
+        """Returns the first album whose normalized name contains the normalized query."""
+        normalized = normalize_album_name(query)
+        if not normalized:
+            return None
+        trigrams = self._inner_trigrams(normalized)
+        if trigrams:
+            # every match contains the rarest trigram; its postings are in playlist order
+            candidates = self._postings.get(self._rarest(trigrams)[0], ())
+        else:
+            # too short for the trigram index
+            candidates = range(len(self._albums))
+        for pos in candidates:
+            if normalized in self._albums_normalized[pos]:
+                return self._albums[pos]
+        return None
+
+    def fuzzy(self, query, threshold=MPD_RANDOM_FUZZY_THRESHOLD):
+        """Returns the album most similar to query, measured as the Jaccard similarity of their
+        trigram sets, or None if no album reaches the threshold.
+        """
+        normalized = normalize_album_name(query)
+        if not normalized:
+            return None
+        trigrams = self._padded_trigrams(normalized)
+        # Count the query trigrams each album shares, rarest first. Common trigrams add little
+        # to the ranking, so stop once the postings budget is used up.
+        shared_counts = collections.Counter()
+        counted = 0
+        for t in self._rarest(trigrams):
+            posting = self._postings.get(t, ())
+            if counted and counted + len(posting) > self.FUZZY_POSTINGS_BUDGET:
+                break
+            shared_counts.update(posting)
+            counted += len(posting)
+        best_pos = None
+        best_key = None
+        for pos, _ in shared_counts.most_common(self.FUZZY_SHORTLIST):
+            name_trigrams = self._name_trigrams[self._albums[pos]]
+            shared = len(trigrams & name_trigrams)
+            similarity = shared / float(len(trigrams) + len(name_trigrams) - shared)
+            key = (-similarity, pos)
+            if similarity >= threshold and (best_key is None or key < best_key):
+                best_pos = pos
+                best_key = key
+        return self._albums[best_pos] if best_pos is not None else None
+
+
 class AlbumList:
     """Manages album information as queried from MPD.
     """
-    def __init__(self, client):
+    def __init__(self, client, pool=None, scorer=None, prefetcher=None):
         self._client = client
+        self._pool = pool
+        self._scorer = scorer
+        self._prefetcher = prefetcher
+        self._staged_album = None
+        # held while the album index is rebuilt or used to choose an album, as next_album()
+        # may be called from another thread (see MultiRoom)
+        self._lock = threading.Lock()
+        self._match_index = AlbumMatchIndex()
+        self._albums = []
+        self._last_song_pos = {}
+        # duration index, see _create_album_list()
+        self._time_prefix = array.array('d', [0])
+        self._run_starts = array.array('l')
+        self._album_durations = {}
+        self._sorted_durations = []
+        self._albums_by_duration = []
         if not os.path.exists(MPD_RANDOM_ALBUM_QUEUE_FILE):
             logging.info("Creating album queue file '{}'".format(MPD_RANDOM_ALBUM_QUEUE_FILE))
             self._write_album_queue([])
 
+    @profiled('refresh.album_list')
     def _create_album_list(self, plinfo):
-        """Returns a list of albums from the playlist info."""
-        self._albums = []
-        for a in plinfo:
-            try:
-                if a['album'] not in self._albums:
-                    self._albums.append(a['album'])
-            except KeyError:
-                logging.debug("createAlbumList, no album key, ignoring entry: {}".format(a))
+        """Returns a list of albums from the playlist info.
 
+        Also builds the duration index from the 'time' of each song:
+        _time_prefix[i] is the total time of the songs before position i, _run_starts holds
+        the start position of each run of consecutive songs from the same album, and
+        _sorted_durations/_albums_by_duration hold the album lengths in ascending order.
+        plinfo must be in playlist order.
+        """
+        # The per-position arrays are array.array to keep them compact on large playlists.
+        albums = []
+        album_durations = {}
+        time_prefix = array.array('d', [0])
+        run_starts = array.array('l')
+        run_album = None
+        for pos, a in enumerate(plinfo):
+            song_time = float(a.get('time') or a.get('duration') or 0)
+            time_prefix.append(time_prefix[-1] + song_time)
+            album_name = a.get('album')
+            if not run_starts or run_album != album_name:
+                run_starts.append(pos)
+                run_album = album_name
+            if album_name is None:
+                logging.debug("createAlbumList, no album key, ignoring entry: %s", a)
+                continue
+            if album_name not in album_durations:
+                albums.append(album_name)
+                album_durations[album_name] = 0
+            album_durations[album_name] += song_time
+        albums_by_duration = sorted(albums, key=album_durations.__getitem__)
+        self._albums = albums
+        self._album_durations = album_durations
+        self._time_prefix = time_prefix
+        self._run_starts = run_starts
+        self._albums_by_duration = albums_by_duration
+        self._sorted_durations = [album_durations[a] for a in albums_by_duration]
+
+    @profiled('refresh.last_song_list')
     def _create_last_song_list(self, plinfo):
         """Manages the _last_song_pos map, which maintains a last song position for each album.
         """
-        self._last_song_pos = {}
-        for a in self._albums:
-            entries = self._client.playlistfind("album", a)
-
+        last_song_pos = {}
+        if self._pool is not None:
+            album_entries = self._pool.map("playlistfind", [("album", a) for a in self._albums])
+        else:
+            album_entries = (self._client.playlistfind("album", a) for a in self._albums)
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for a, entries in zip(self._albums, album_entries):
             # skip if size of entries is zero
             if len(entries) == 0:
                 continue
+            elif not debug:
+                pass
             elif len(entries) == 1:
-                logging.debug("Single file album={}: {}".format(a, song_info(entries[-1])))
+                logging.debug("Single file album=%s: %s", a, song_info(entries[-1]))
             else:
-                logging.debug("Last song for album={}: {}".format(a, song_info(entries[-1])))
+                logging.debug("Last song for album=%s: %s", a, song_info(entries[-1]))
 
             # pick pos from last entry that is returned
-            self._last_song_pos[a] = entries[-1]['pos']
+            last_song_pos[a] = entries[-1]['pos']
+        self._last_song_pos = last_song_pos
 
+    @profiled('select')
     def _choose_random_album(self, current_album_name):
         """Selects a random album from the current playlist, doing its best to avoid choosing
         the current album.
         """
-        if len(self._albums) < 1:
+        # choose from the first num_candidates of candidates
+        candidates = self._albums
+        num_candidates = len(self._albums)
+        max_duration = None
+        if MPD_RANDOM_TIME_BUDGET is not None:
+            num_fitting = self.count_albums_fitting(MPD_RANDOM_TIME_BUDGET * 60)
+            if num_fitting < 1:
+                logging.info("No album fits in {} minutes, choosing from all albums".format(MPD_RANDOM_TIME_BUDGET))
+            else:
+                candidates = self._albums_by_duration
+                num_candidates = num_fitting
+                max_duration = MPD_RANDOM_TIME_BUDGET * 60
+        if num_candidates < 1:
             logging.warn("No albums found")
             album_name = current_album_name
-        elif len(self._albums) == 1:
-            logging.debug("only one album found: {}".format(self._albums))
-            album_name = self._albums[0]
+        elif num_candidates == 1:
+            logging.debug("only one album found: {}".format(candidates[0]))
+            album_name = candidates[0]
+        elif self._scorer is not None:
+            album_name = self._scorer.choose(current_album_name, max_duration)
+            if album_name is None:
+                logging.warn("No album has a non-zero selection weight")
+                album_name = current_album_name
         else:
             for i in range(0,3):
                 # pick a random album from the list of album names we've built
-                new_album_index = random.choice(range(0, len(self._albums) - 1))
-                album_name = self._albums[new_album_index]
+                new_album_index = random.randrange(num_candidates)
+                album_name = candidates[new_album_index]
                 # If we've picked the same album as current then
                 # lets keep trying (a few times before giving up)
                 if album_name != current_album_name:
@@ -364,8 +1264,11 @@ class AlbumList:
             with open(MPD_RANDOM_ALBUM_QUEUE_ARCHIVE_FILE, 'a') as f:
                 f.write(album_name + '\n')
 
-    def _process_album_queue(self):
-        """Process the album queue file. Selects a matching album from the queue, or returns None if not found."""
+    @profiled('album_queue')
+    def _process_album_queue(self, consume=True):
+        """Process the album queue file. Selects a matching album from the queue, or returns None if not found.
+        If consume is False the queue file is left as it is.
+        """
         if not os.path.exists(MPD_RANDOM_ALBUM_QUEUE_FILE):
             logging.warn("Album queue file does not exist '{}'".format(MPD_RANDOM_ALBUM_QUEUE_FILE))
             return None
@@ -377,67 +1280,165 @@ class AlbumList:
         try:
             while len(album_q_list) > 0:
                 queued_album = album_q_list.pop(0).strip()
-                for album_name in self._albums:
-                    if queued_album.startswith('!'):
-                        # exact match
-                        if queued_album.lstrip('!') == album_name:
-                            logging.info("Album queue: exact matched '{}'".format(queued_album))
-                            self._write_album_queue_archive(queued_album)
-                            return album_name
-                    else:
-                        # substring match (default)
-                        if queued_album in album_name:
-                            logging.info("Album queue: matched '{}' in '{}".format(queued_album, album_name))
-                            self._write_album_queue_archive(queued_album)
-                            return album_name
+                if queued_album.startswith('!'):
+                    album_name = self._match_index.exact(queued_album.lstrip('!'))
+                elif queued_album.startswith('~'):
+                    album_name = self._match_index.fuzzy(queued_album.lstrip('~'))
+                else:
+                    album_name = self._match_index.substring(queued_album)
+                if album_name is not None:
+                    logging.info("Album queue: matched '{}' to '{}'".format(queued_album, album_name))
+                    if consume:
+                        self._write_album_queue_archive(queued_album)
+                    return album_name
         finally:
-            self._write_album_queue(album_q_list)
+            if consume:
+                self._write_album_queue(album_q_list)
         logging.info("Album queue: No matching album found from '{}'".format(MPD_RANDOM_ALBUM_QUEUE_FILE))
         return None
 
+    @profiled('refresh.fetch')
+    def _fetch_playlist_info(self):
+        """Returns the full playlistinfo. If we have a connection pool the playlist is requested
+        in windows of MPD_RANDOM_FETCH_WINDOW entries, fetched concurrently and joined back in
+        playlist order, so album runs which span a window boundary are merged as usual.
+        """
+        if self._pool is None:
+            return self._client.playlistinfo()
+        length = int(self._client.status()['playlistlength'])
+        windows = [("{}:{}".format(start, min(start + MPD_RANDOM_FETCH_WINDOW, length)),)
+                   for start in range(0, length, MPD_RANDOM_FETCH_WINDOW)]
+        plinfo = []
+        for window in self._pool.map("playlistinfo", windows):
+            plinfo.extend(window)
+        return plinfo
+
+    @profiled('refresh')
     def refresh(self):
         """Refreshes the album list.
         """
-        plinfo = self._client.playlistinfo()
-        self._create_album_list(plinfo)
+        time_start = time.time()
+        plinfo = self._fetch_playlist_info()
+        with self._lock:
+            # the staged album may be gone or moved; choose again at the end of the album
+            self._staged_album = None
+            self._create_album_list(plinfo)
+            self._match_index.update(self._albums)
+            if self._scorer is not None:
+                self._scorer.sync(self._albums, plinfo)
+        # queries mpd once per album, so done without the lock. _last_song_pos is only used by
+        # is_last_song_in_album(), from the thread which refreshes.
         self._create_last_song_list(plinfo)
+        logging.info("Refreshed {} songs, {} albums in {:.3f}s ({} extra connections)".format(
+            len(plinfo), len(self._albums), time.time() - time_start,
+            self._pool.size if self._pool is not None else 0))
+
+    def time_left_in_album(self, pos, elapsed=0):
+        """Returns the seconds left until the end of the run of songs from the same album as
+        the song at pos, given the seconds elapsed in that song.
+        """
+        i = bisect.bisect_right(self._run_starts, pos) - 1
+        if i < 0:
+            return 0
+        run_end = self._run_starts[i + 1] if i + 1 < len(self._run_starts) else len(self._time_prefix) - 1
+        return max(self._time_prefix[run_end] - self._time_prefix[pos] - elapsed, 0)
+
+    def time_left_in_queue(self, pos, elapsed=0):
+        """Returns the seconds left until the end of the playlist, given the song at pos and
+        the seconds elapsed in it.
+        """
+        if pos >= len(self._time_prefix) - 1:
+            return 0
+        return max(self._time_prefix[-1] - self._time_prefix[pos] - elapsed, 0)
+
+    def count_albums_fitting(self, seconds):
+        """Returns the number of albums no longer than the given number of seconds. These are
+        the first ones in _albums_by_duration.
+        """
+        return bisect.bisect_right(self._sorted_durations, seconds)
 
     def get_album_names(self):
         """Returns list of album names.
         """
         return self._albums
 
+    @profiled('is_last_song_in_album')
     def is_last_song_in_album(self, currentsong):
         """Given a song entry, returns 1 if song is last in album.
         """
         if currentsong == None or len(currentsong) < 1:
             return False
         if 'album' not in currentsong:
-            logging.info("current song has no album, ignoring: {}".format(currentsong))
+            logging.info("current song has no album, ignoring: %s", currentsong)
             return False
         try:
             if currentsong['pos'] == self._last_song_pos[currentsong['album']]:
-                logging.info("is last song: {}".format(song_info(currentsong)))
+                logging.info("is last song: %s", song_info(currentsong))
                 return True
         except KeyError:
-            logging.error("Caught KeyError current pos: {}, currentsong['album']: {}".format(currentsong['pos'],
-                                                                                             currentsong['album']))
+            logging.error("Caught KeyError current pos: %s, currentsong['album']: %s", currentsong['pos'],
+                          currentsong['album'])
             return False
-        logging.debug("not last song: {}, current pos: {} / last pos: {}".format(song_info(currentsong),
-                                                                                 currentsong['pos'],
-                                                                                 self._last_song_pos[currentsong['album']]))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("not last song: %s, current pos: %s / last pos: %s", song_info(currentsong),
+                          currentsong['pos'], self._last_song_pos[currentsong['album']])
         return False
 
+    def _choose_next_album(self, current_album_name, consume=True):
+        """Chooses the next album, either by album queue or random.
+        """
+        album_name = self._process_album_queue(consume)
+        if album_name is None:
+            album_name = self._choose_random_album(current_album_name)
+        return album_name
+
+    def stage_next_album(self, current_album_name):
+        """Chooses the album to play after the current one ahead of time, and starts prefetching
+        its files. Does nothing unless prefetching is enabled, or if an album is already staged.
+        The album queue is only looked at, next_album() consumes it.
+        """
+        if self._prefetcher is None or self._staged_album is not None:
+            return
+        if os.path.exists(MPD_RANDOM_SUSPEND_FILE):
+            return
+        with self._lock:
+            album_name = self._choose_next_album(current_album_name, consume=False)
+            if album_name is None:
+                return
+            logging.info("staged next album: {}".format(album_name))
+            self._staged_album = album_name
+        self._prefetcher.prefetch(e['file'] for e in self._client.playlistfind("album", album_name))
+
+    def unstage_next_album(self):
+        """Drops the staged album, if any, so that the next stage_next_album() chooses again.
+        """
+        if self._staged_album is not None:
+            logging.debug("dropping staged album: %s", self._staged_album)
+            self._staged_album = None
+
+    def next_album(self, current_album_name=None):
+        """Returns the album to play after current_album_name: the album queue comes first, then
+        the staged album if there is one, otherwise a random one.
+        """
+        with self._lock:
+            staged_album = self._staged_album
+            self._staged_album = None
+            album_name = self._process_album_queue()
+            if album_name is None:
+                album_name = staged_album
+                if album_name is None or album_name == current_album_name or album_name not in self._album_durations:
+                    album_name = self._choose_random_album(current_album_name)
+            if album_name is not None and self._scorer is not None:
+                self._scorer.record_pick(album_name)
+        return album_name
+
     def play_next_album(self, current_album_name=None):
         """Plays a random album on the current playlist.
         """
         if os.path.exists(MPD_RANDOM_SUSPEND_FILE):
             logging.info("Suspended by presence of {}, not choosing next album".format(MPD_RANDOM_SUSPEND_FILE))
             return
-        # choose next album, either by album queue or random
-        album_name = self._process_album_queue()
-        if album_name is None:
-            album_name = self._choose_random_album(current_album_name)
+        album_name = self.next_album(current_album_name)
         if album_name is None:
             print("ERROR: could not find an album to play")
             return
@@ -455,6 +1456,7 @@ class AlbumList:
     def print_debug_info(self):
         print("Albums: {}".format(self._albums))
         print("Last Song Positions: {}".format(self._last_song_pos))
+        print("Album Durations: {}".format({a: format_duration(d) for a, d in self._album_durations.items()}))
 
 
 ###############################################################################
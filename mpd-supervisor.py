@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+#    This script starts and supervises mpd, mpdscribble and mpd-random-playlist-album.py.
+#    Copyright (C) 2009  Kyle MacLeod  kyle.macleod is at gmail
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Description
+-----------
+This script starts mpd, mpdscribble and mpd-random-playlist-album.py in daemon mode,
+and keeps them running.
+
+mpd is only started if nothing is answering on $MPD_HOST/$MPD_PORT. Once started, the
+script waits until mpd accepts connections before starting the others. mpdscribble
+is only started if it is not already running. The album daemon holds a lock file
+(see mpd-random-playlist-album.py), so a second copy exits immediately and is not
+restarted.
+
+Children started by this script are run in the foreground (--no-daemon) and restarted
+when they exit, with an exponential backoff if they keep failing. On SIGTERM or SIGINT
+the children are terminated.
+
+Options:
+
+    -h|--help
+    -D|--debug         : Print debug messages to stdout
+    -r|--ready-fd N    : Write 'ready' to file descriptor N and close it once mpd accepts
+                         connections. If mpd does not start, N is closed without writing.
+
+Environment:
+
+    MPD                       : mpd executable [default=mpd]
+    MPDSCRIBBLE               : mpdscribble executable [default=mpdscribble]. Set to '' to disable.
+    MPD_RANDOM_PLAYLIST_ALBUM : album daemon command line
+                                [default=mpd-random-playlist-album.py -d, from this directory]
+    MPD_RANDOM_PLAYLIST_ALBUM_LOG : album daemon output [default=/tmp/mpd-random-playlist-album.log]
+    MPD_READY_TIMEOUT         : seconds to wait for mpd to accept connections [default=30]
+
+Examples
+--------
+
+    ./mpd-supervisor.py &
+"""
+
+import errno
+import getopt
+import logging
+import os
+import os.path
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+MPD = os.getenv('MPD', 'mpd')
+MPDSCRIBBLE = os.getenv('MPDSCRIBBLE', 'mpdscribble')
+
+MPD_RANDOM_PLAYLIST_ALBUM = os.getenv('MPD_RANDOM_PLAYLIST_ALBUM')
+if MPD_RANDOM_PLAYLIST_ALBUM is None:
+    MPD_RANDOM_PLAYLIST_ALBUM = '{} {} -d'.format(
+        shlex.quote(sys.executable),
+        shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mpd-random-playlist-album.py')))
+
+MPD_RANDOM_PLAYLIST_ALBUM_LOG = os.getenv('MPD_RANDOM_PLAYLIST_ALBUM_LOG')
+if MPD_RANDOM_PLAYLIST_ALBUM_LOG is None:
+    MPD_RANDOM_PLAYLIST_ALBUM_LOG = os.path.join(tempfile.gettempdir(), 'mpd-random-playlist-album.log')
+
+MPD_READY_TIMEOUT = float(os.getenv('MPD_READY_TIMEOUT', '30'))
+
+# Exit status of mpd-random-playlist-album.py when another daemon is already running
+EXIT_ALREADY_RUNNING = 3
+
+# Restart backoff, in seconds. The backoff is reset once a child has been up for BACKOFF_RESET.
+BACKOFF_INITIAL = 1
+BACKOFF_MAX = 300
+BACKOFF_RESET = 60
+
+# Seconds between checks for exited children while a restart is pending
+POLL_INTERVAL = 0.5
+
+
+def script_help():
+    print(__doc__)
+    sys.exit(-1)
+
+
+def mpd_address():
+    """Returns the socket family and address of mpd, from MPD_HOST and MPD_PORT.
+    """
+    mpd_host = os.getenv('MPD_HOST', 'localhost')
+    mpd_host = mpd_host.split('@')[-1]
+    if mpd_host.startswith('/'):
+        return socket.AF_UNIX, mpd_host
+    return socket.AF_INET, (mpd_host, int(os.getenv('MPD_PORT', '6600')))
+
+
+def mpd_is_ready():
+    """Returns True if mpd accepts a connection and sends its greeting.
+    """
+    family, address = mpd_address()
+    try:
+        if family == socket.AF_UNIX:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(1)
+            sock.connect(address)
+        else:
+            sock = socket.create_connection(address, timeout=1)
+        try:
+            return sock.makefile('rb').readline().startswith(b'OK MPD')
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout):
+        return False
+
+
+def wait_for_mpd(child):
+    """Waits until mpd accepts connections. Returns False if it did not within MPD_READY_TIMEOUT,
+    or if the mpd child process exited.
+    """
+    time_start = time.time()
+    delay = 0.01
+    while time.time() - time_start < MPD_READY_TIMEOUT:
+        if mpd_is_ready():
+            logging.info("mpd ready after {:.3f}s".format(time.time() - time_start))
+            return True
+        if child.proc is not None and child.proc.poll() is not None:
+            logging.error("mpd exited with status {} during startup".format(child.proc.returncode))
+            return False
+        # connection refused comes back immediately, so back off a little between attempts
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+    logging.error("mpd did not accept connections within {}s".format(MPD_READY_TIMEOUT))
+    return False
+
+
+def is_running(name):
+    """Returns True if a process with the given executable name is running.
+    """
+    return subprocess.call(['pgrep', '-x', os.path.basename(name)], stdout=subprocess.DEVNULL) == 0
+
+
+class Child:
+    """A supervised child process, restarted with exponential backoff when it exits.
+    """
+    def __init__(self, name, argv, log_file=None):
+        self.name = name
+        self.argv = argv
+        self.log_file = log_file
+        self.proc = None
+        self.restart_at = None
+        self._backoff = BACKOFF_INITIAL
+        self._time_started = None
+
+    def start(self):
+        logging.info("starting {}: {}".format(self.name, ' '.join(self.argv)))
+        output = None
+        if self.log_file is not None:
+            output = open(self.log_file, 'a')
+        try:
+            self.proc = subprocess.Popen(self.argv, stdout=output, stderr=subprocess.STDOUT if output else None)
+        except OSError as e:
+            logging.error("could not start {}: {}".format(self.name, e))
+            self.proc = None
+            self._schedule_restart()
+            return
+        finally:
+            if output is not None:
+                output.close()
+        self.restart_at = None
+        self._time_started = time.time()
+
+    def exited(self, returncode):
+        """Called once the child has been reaped. Schedules a restart if appropriate.
+        """
+        logging.warning("{} (pid {}) exited with status {}".format(self.name, self.proc.pid, returncode))
+        self.proc = None
+        if returncode == EXIT_ALREADY_RUNNING and self.name == 'album':
+            logging.info("album daemon is already running elsewhere, not restarting")
+            return
+        if time.time() - self._time_started > BACKOFF_RESET:
+            self._backoff = BACKOFF_INITIAL
+        self._schedule_restart()
+
+    def _schedule_restart(self):
+        logging.info("restarting {} in {}s".format(self.name, self._backoff))
+        self.restart_at = time.time() + self._backoff
+        self._backoff = min(self._backoff * 2, BACKOFF_MAX)
+
+    def terminate(self):
+        if self.proc is not None and self.proc.poll() is None:
+            logging.info("stopping {} (pid {})".format(self.name, self.proc.pid))
+            self.proc.terminate()
+            self.proc.wait()
+
+
+def supervise(children):
+    """Reaps and restarts children until none are left to run.
+    """
+    while True:
+        now = time.time()
+        for child in children:
+            if child.proc is None and child.restart_at is not None and child.restart_at <= now:
+                child.start()
+        running = [c for c in children if c.proc is not None]
+        pending = [c.restart_at for c in children if c.proc is None and c.restart_at is not None]
+        if not running and not pending:
+            logging.info("nothing left to supervise")
+            return
+        if pending:
+            # don't block past the next scheduled restart, and keep reaping the other children
+            # while waiting for it
+            pid, status = os.waitpid(-1, os.WNOHANG) if running else (0, 0)
+            if pid == 0:
+                time.sleep(max(0, min(min(pending) - time.time(), POLL_INTERVAL)))
+                continue
+        else:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+        for child in running:
+            if child.proc.pid == pid:
+                child.proc.returncode = os.waitstatus_to_exitcode(status)
+                child.exited(child.proc.returncode)
+
+
+def handle_signal(signum, frame):
+    raise SystemExit(0)
+
+
+def signal_ready(ready_fd):
+    """Tells whoever started us that mpd is ready, see --ready-fd.
+    """
+    if ready_fd is None:
+        return
+    try:
+        os.write(ready_fd, b'ready\n')
+    except OSError as e:
+        logging.warning("could not write to ready fd {}: {}".format(ready_fd, e))
+    finally:
+        os.close(ready_fd)
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hDr:", ["help", "debug", "ready-fd="])
+    except getopt.GetoptError:
+        # print help information and exit:
+        script_help()
+        return 2
+    arg_loglevel = logging.INFO
+    arg_ready_fd = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            script_help()
+        elif o in ("-D", "--debug"):
+            arg_loglevel = logging.DEBUG
+        elif o in ("-r", "--ready-fd"):
+            try:
+                arg_ready_fd = int(a)
+            except ValueError:
+                script_help()
+    logging.basicConfig(level=arg_loglevel, format='%(asctime)s %(levelname)s: %(message)s')
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    children = []
+    try:
+        if mpd_is_ready():
+            logging.info("mpd is already running")
+        else:
+            mpd_child = Child('mpd', [MPD, '--no-daemon'])
+            children.append(mpd_child)
+            mpd_child.start()
+            if not wait_for_mpd(mpd_child):
+                return 1
+        signal_ready(arg_ready_fd)
+        if MPDSCRIBBLE:
+            if is_running(MPDSCRIBBLE):
+                logging.info("mpdscribble is already running")
+            else:
+                children.append(Child('mpdscribble', [MPDSCRIBBLE, '--no-daemon']))
+                children[-1].start()
+        children.append(Child('album', shlex.split(MPD_RANDOM_PLAYLIST_ALBUM), MPD_RANDOM_PLAYLIST_ALBUM_LOG))
+        children[-1].start()
+        supervise(children)
+    finally:
+        for child in reversed(children):
+            child.terminate()
+    return 0
+
+
+###############################################################################
+if __name__ == "__main__" or __name__ == "main":
+    sys.exit(main())
+###############################################################################
@@ -2,39 +2,25 @@
 
 # Variables defining executables (override as needed)
 #
-MPD=mpd
-MPDSCRIBBLE=mpdscribble
+export MPD=${MPD:-mpd}
+export MPDSCRIBBLE=${MPDSCRIBBLE-mpdscribble}
 
 # note: you might want to remove the -D (verbose) here:
-#MPD_RANDOM_PLAYLIST_ALBUM="mpd-random-playlist-album.py -d -D"
-MPD_RANDOM_PLAYLIST_ALBUM="mpd-random-playlist-album.py -d -D"
+#export MPD_RANDOM_PLAYLIST_ALBUM="mpd-random-playlist-album.py -d -D"
+export MPD_RANDOM_PLAYLIST_ALBUM=${MPD_RANDOM_PLAYLIST_ALBUM:-"mpd-random-playlist-album.py -d -D"}
 
 
-# Check for daemons and start if necessary
-#
+export MPD_SUPERVISOR_LOG=${MPD_SUPERVISOR_LOG:-/tmp/mpd-supervisor.log}
 
-if [ "$(pgrep -x $MPD | wc -l)" -lt 1 ]; then
-  echo "starting mpd with: $MPD"
-  $MPD
-  count=1
-  while [ "$(pgrep -x $MPD | wc -l)" -lt 1 ]; do
-     count=$((count+1))
-     if [ "$count" -gt 5 ]; then
-       echo "mpd did not start!"
-       exit 1
-     fi
-     echo "waiting for mpd to start"
-     sleep 1
-  done
-fi
 
-if [ "$(pgrep -x $MPDSCRIBBLE | wc -l)" -lt 1 ]; then
-  echo "starting mpdscribble with: $MPDSCRIBBLE"
-  $MPDSCRIBBLE
-fi
-
-# shellcheck disable=SC2046,SC2009,SC2126
-if [ $(ps -ef | grep "$MPD_RANDOM_PLAYLIST_ALBUM" | grep python | grep -v grep | wc -l) -lt 1 ]; then
-  echo "starting mpd-random-playlist-album.py with: $MPD_RANDOM_PLAYLIST_ALBUM"
-  ("$MPD_RANDOM_PLAYLIST_ALBUM" >> /tmp/mpd-random-playlist-album.log 2>&1) &
+# Start the daemons (if necessary) and keep them running, in the background.
+# See mpd-supervisor.py for details.
+#
+# As before, return once mpd is ready: the supervisor writes 'ready' to fd 3, which is
+# the pipe read here, as soon as mpd accepts connections, and closes it.
+echo "starting mpd-supervisor.py, logging to $MPD_SUPERVISOR_LOG"
+ready=$(nohup "$(dirname "$0")/mpd-supervisor.py" --ready-fd 3 "$@" 3>&1 >> "$MPD_SUPERVISOR_LOG" 2>&1 &)
+if [ "$ready" != "ready" ]; then
+  echo "mpd did not start! See $MPD_SUPERVISOR_LOG"
+  exit 1
 fi